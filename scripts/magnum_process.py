@@ -1,531 +1,3231 @@
 import argparse
+import heapq
+import codecs
+import errno
+import gzip
 import importlib
+import ipaddress
 import json
+import math
+import mmap
 import os
+import queue
 import random
 import re
 import select
 import socket
+import socketserver
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from array import array
+
+# access the process name from a string like "Services: magstoresrv Total Resident Memory"
+serviceLabel = re.compile(r"Services:\s([\w\-]+)\s")
+
+# words of any other label (ie cluster resources) that may name a service
+labelWords = re.compile(r"[\w\-]+")
+
+# json tokens the stream parser cares about. a string without its closing quote yet can only
+# match the lone quote, which marks where to pick up again once more data arrives.
+streamTokens = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"|"|[{}\[\]]')
+jsonDecoder = json.JSONDecoder()
+
+# the same tokens in a capture file, which is searched as bytes
+captureTokens = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"|[{}\[\]]')
+captureStart = re.compile(rb"\S")
+
+# cluster metric labels like "Cluster: Maintenance mode", "Cluster: Online (magnum-1)",
+# "Cluster: Server magnum-1" and "Cluster: Resource cl-token"
+clusterLabel = re.compile(
+    r"Cluster: (?:(Maintenance mode)|Online \(([^)]*)\)|Server (\S+)|Resource (\S+))"
+)
+
+# tokens are the different resource names that control the cluster ip
+clusterTokens = ("cl-token", "cl-ip1", "db-ip1", "db-token")
+
+# metric kinds in order of precedence, matched once per label
+metricKinds = (
+    ("State", "state"),
+    ("CPU Usage (%)", "cpu"),
+    ("Memory Usage (%)", "memory"),
+    ("Total Resident Memory", "resident"),
+    ("Cluster: Resource", "cluster"),
+    ("Main PID", "pid"),
+)
+
+byteUnits = {
+    "B": 1,
+    "K": 1000,
+    "M": 1000000,
+    "G": 1000000000,
+    "T": 1000000000000,
+}
+
+
+def parse_percent(value):
+
+    return round(float(value.strip("%")) / 100, 3)
+
+
+def parse_bytes(value):
+
+    # "12.5M" -> 12500000
+    try:
+        return int(float(value[:-1]) * byteUnits[value[-1]])
+
+    except Exception:
+        return 0
+
+
+def parse_value(value):
+
+    return value
+
+
+def parse_pid(value):
+
+    try:
+        return int(value)
+
+    except ValueError:
+        return None
+
+
+# service document field and value parser for each metric kind (state is handled on its own)
+metricParsers = {
+    "cpu": ("d_cpu_p", parse_percent),
+    "memory": ("d_memory_p", parse_percent),
+    "resident": ("l_memory_b", parse_bytes),
+    "cluster": ("s_cluster", parse_value),
+    "pid": ("i_pid", parse_pid),
+}
+
+
+# json text of the document keys per record type, built the first time a type is written
+recordLayouts = {}
+
+
+def encodeValue(value):
+
+    # json text of a document value, the same as json.dumps gives
+    kind = value.__class__
+
+    if kind is str:
+        return json.encoder.encode_basestring_ascii(value)
+
+    if kind is int:
+        return int.__repr__(value)
+
+    if kind is float and math.isfinite(value):
+        return float.__repr__(value)
+
+    return json.dumps(value)
+
+
+class metricRecord:
+
+    # one health metric of a host, kept between polls and refreshed with each new value
+    __slots__ = ("label", "value", "status", "kind")
+
+    def __init__(self, label, kind):
+
+        self.label = label
+        self.kind = kind
+        self.value = None
+        self.status = None
+
+    def to_list(self):
+
+        return [self.label, self.value, self.status]
+
+
+class statusRecord:
+
+    # base for the document records. fields are the document keys in output order and the
+    # record answers like the dict it replaces (keys, items, [] and get).
+    __slots__ = ()
+
+    fields = ()
+    defaults = ()
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+
+        for field, default in zip(self.fields, self.defaults):
+            setattr(self, field, default)
+
+    def __getitem__(self, key):
+
+        try:
+            return getattr(self, key)
+
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.fields
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def __len__(self):
+        return len(self.fields)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def keys(self):
+        return self.fields
+
+    def items(self):
+        return [(field, getattr(self, field)) for field in self.fields]
+
+    def to_dict(self):
+
+        # document fields, leaving out None values so they don't break the poller
+        document = {}
+
+        for field in self.fields:
+
+            value = getattr(self, field)
+
+            if value is not None:
+                document[field] = value
+
+        return document
+
+    def to_json(self):
+
+        # to_dict as json text without building the dict. the key text is reused from the
+        # layout of the record type.
+        try:
+            layout = recordLayouts[self.__class__]
+
+        except KeyError:
+
+            layout = tuple((field, json.dumps(field) + ": ") for field in self.fields)
+            recordLayouts[self.__class__] = layout
+
+        parts = []
+
+        for field, key in layout:
+
+            value = getattr(self, field)
+
+            if value is not None:
+                parts.append(key + encodeValue(value))
+
+        return "{" + ", ".join(parts) + "}"
+
+
+class serviceRecord(statusRecord):
+
+    fields = (
+        "s_service",
+        "s_state",
+        "i_id",
+        "d_cpu_p",
+        "d_memory_p",
+        "l_memory_b",
+        "i_pid",
+        "s_cluster",
+        "s_status",
+        "d_cpu_p_avg",
+        "d_memory_p_avg",
+        "d_memory_b_rate",
+        "i_restarts",
+        "i_flaps",
+        "s_system",
+        "s_type",
+    )
+    defaults = (None, "Not Available", -1, 0, 0, 0, None, None, None) + (None,) * 6 + ("service",)
+
+    __slots__ = fields
+
+
+class restartRecord(statusRecord):
+
+    fields = (
+        "s_service",
+        "i_pid",
+        "i_previous_pid",
+        "d_since_restart_s",
+        "s_state",
+        "s_system",
+        "s_type",
+    )
+    defaults = (None, None, None, None, None, None, "restart")
+
+    __slots__ = fields
+
+
+class serviceHistory:
+
+    # the last size polls of one service in fixed arrays, written round robin. restarts and
+    # flaps are flagged as each sample comes in, so the window totals are a plain sum. it's
+    # also the one place a restart is detected: a pid that differs from the last known one.
+    __slots__ = (
+        "size",
+        "count",
+        "times",
+        "cpu",
+        "memory",
+        "resident",
+        "pid",
+        "state",
+        "restarts",
+        "flaps",
+        "last_pid",
+        "restarted",
+        "since",
+    )
+
+    def __init__(self, size):
+
+        self.size = size
+        self.count = 0
+
+        # last known pid, when the latest restart was and the time since the one before that
+        self.last_pid = -1
+        self.restarted = None
+        self.since = None
+
+        self.times = array("d", bytes(8 * size))
+        self.cpu = array("d", bytes(8 * size))
+        self.memory = array("d", bytes(8 * size))
+        self.resident = array("q", bytes(8 * size))
+        self.pid = array("q", bytes(8 * size))
+        self.state = array("b", bytes(size))
+        self.restarts = array("b", bytes(size))
+        self.flaps = array("b", bytes(size))
+
+    def add(self, now, record):
+
+        # returns the pid the service had before, when it's been restarted since the last poll
+        index = self.count % self.size
+        previous = (self.count - 1) % self.size
+
+        pid = -1 if record.i_pid is None else record.i_pid
+
+        restarted = None
+
+        if pid >= 0:
+
+            if self.last_pid >= 0 and pid != self.last_pid:
+
+                restarted = self.last_pid
+
+                self.since = now - self.restarted if self.restarted is not None else None
+                self.restarted = now
+
+            self.last_pid = pid
+
+        if self.count:
+            self.flaps[index] = record.i_id != self.state[previous]
+
+        else:
+            self.flaps[index] = 0
+
+        self.restarts[index] = restarted is not None
+
+        self.times[index] = now
+        self.cpu[index] = record.d_cpu_p
+        self.memory[index] = record.d_memory_p
+        self.resident[index] = record.l_memory_b
+        self.pid[index] = pid
+        self.state[index] = record.i_id
+
+        self.count += 1
+
+        return restarted
+
+    def update(self, record):
+
+        # rolling averages, resident memory growth (bytes/s) and the restarts and state
+        # changes over the window
+        samples = min(self.count, self.size)
+
+        if samples < self.size:
+
+            cpu = self.cpu[:samples]
+            memory = self.memory[:samples]
+            restarts = self.restarts[:samples]
+            flaps = self.flaps[:samples]
+
+        else:
+
+            cpu = self.cpu
+            memory = self.memory
+            restarts = self.restarts
+            flaps = self.flaps
+
+        oldest = (self.count - samples) % self.size
+        newest = (self.count - 1) % self.size
+        elapsed = self.times[newest] - self.times[oldest]
+
+        record.d_cpu_p_avg = round(math.fsum(cpu) / samples, 3)
+        record.d_memory_p_avg = round(math.fsum(memory) / samples, 3)
+        record.d_memory_b_rate = (
+            round((self.resident[newest] - self.resident[oldest]) / elapsed, 3) if elapsed else 0
+        )
+        record.i_restarts = sum(restarts)
+        record.i_flaps = sum(flaps)
+
+        # once the ring has wrapped, the oldest flags compare against a sample that's gone
+        if self.count > self.size:
+
+            record.i_restarts -= self.restarts[oldest]
+            record.i_flaps -= self.flaps[oldest]
+
+
+def percentile(values, percent):
+
+    # nearest rank percentile
+    if not values:
+        return 0
+
+    ordered = sorted(values)
+
+    return ordered[max(int(math.ceil(percent / 100.0 * len(ordered))) - 1, 0)]
+
+
+def topServices(names, values, count):
+
+    # "name (value)" of the largest values, largest first
+    top = heapq.nlargest(count, range(len(values)), key=values.__getitem__)
+
+    return ", ".join("%s (%s)" % (names[index], round(values[index], 3)) for index in top) or None
+
+
+class overallRecord(statusRecord):
+
+    fields = (
+        "s_service",
+        "s_state",
+        "d_cpu_p",
+        "d_memory_p",
+        "l_memory_b",
+        "i_num_services",
+        "i_num_failed",
+        "d_cpu_p_max",
+        "d_cpu_p_p95",
+        "d_memory_p_max",
+        "d_memory_p_p95",
+        "l_memory_b_max",
+        "s_top_cpu",
+        "s_top_memory",
+        "s_status",
+        "s_system",
+        "s_type",
+    )
+    defaults = (
+        "overall_health",
+        "Running",
+        0,
+        0,
+        0,
+        0,
+        0,
+        0,
+        0,
+        0,
+        0,
+        0,
+        None,
+        None,
+        None,
+        None,
+        "overall",
+    )
+
+    __slots__ = fields
+
+    def rollup(self, names, cpu, memory, resident, top):
+
+        # totals, peaks and the busiest services from the per service arrays, all worked out
+        # in one go (and rounded once) rather than a running sum per service
+        self.d_cpu_p = round(math.fsum(cpu), 3)
+        self.d_memory_p = round(math.fsum(memory), 3)
+        self.l_memory_b = sum(resident)
+
+        if names:
+
+            self.d_cpu_p_max = max(cpu)
+            self.d_cpu_p_p95 = percentile(cpu, 95)
+            self.d_memory_p_max = max(memory)
+            self.d_memory_p_p95 = percentile(memory, 95)
+            self.l_memory_b_max = max(resident)
+
+            self.s_top_cpu = topServices(names, cpu, top)
+            self.s_top_memory = topServices(names, memory, top)
+
+
+class clusterRecord(overallRecord):
+
+    fields = overallRecord.fields + ("i_num_hosts",)
+    defaults = ("cluster_health",) + overallRecord.defaults[1:-1] + ("cluster", 0)
+
+    __slots__ = ("i_num_hosts",)
+
+
+class clusterResource:
+
+    # one row of a host's cluster resource table
+    __slots__ = ("name", "node", "role", "running")
+
+    def __init__(self, name, node, role, running):
+
+        self.name = name
+        self.node = node
+        self.role = role
+        self.running = running
+
+
+class redundancyRecord(statusRecord):
+
+    fields = (
+        "s_host",
+        "s_status",
+        "s_maintenance",
+        "s_online",
+        "i_resources_running",
+        "i_resources_stopped",
+        "s_resources_stopped",
+        "s_resources_failed",
+        "s_system",
+        "s_type",
+    )
+    defaults = (None, None, None, None, 0, 0, None, None, None, "redundancy")
+
+    # the resource table isn't a document field
+    __slots__ = fields + ("resources",)
+
+    def reset(self):
+
+        statusRecord.reset(self)
+        self.resources = []
+
+
+def parse_cluster_label(label):
+
+    # ("maintenance" / "online" / "server" / "resource", name or None, controls the cluster ip)
+    match = clusterLabel.search(label)
+    token = any(match in label for match in clusterTokens)
+
+    if not match:
+        return None, None, token
+
+    maintenance, online, server, resource = match.groups()
+
+    if maintenance:
+        return "maintenance", None, token
+
+    if online is not None:
+        return "online", online, token
+
+    if server:
+        return "server", server, token
+
+    return "resource", resource, token
+
+
+def parse_cluster_value(value):
+
+    # "Started", "Started magnum-1" or "Started (magnum-1)" -> role, node and if it's running
+    words = value.replace("(", " ").replace(")", " ").split()
+
+    role = words[0] if words else value
+    node = words[1] if len(words) > 1 else None
+
+    return role, node, any(match in value for match in ("Started", "Slave", "Master"))
+
+
+def recordJSON(record):
+
+    # json.dumps default for printing records
+    return record.to_list() if isinstance(record, metricRecord) else record.to_dict()
+
+
+class timingHistogram:
+
+    # bucket upper bounds in milliseconds, anything slower lands in the last bucket
+    bounds = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+    def __init__(self):
+
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+
+        ms = seconds * 1000
+
+        self.count += 1
+        self.total += ms
+        self.max = ms if ms > self.max else self.max
+
+        index = 0
+        for bound in self.bounds:
+
+            if ms <= bound:
+                break
+
+            index += 1
+
+        self.buckets[index] += 1
+
+    def percentile(self, percent):
+
+        # upper bound of the bucket the percentile falls in, not a measured time. the summary
+        # names it *_bucket_ms so it isn't read as one.
+        target = self.count * percent / 100.0
+        seen = 0
+
+        for index, count in enumerate(self.buckets):
+
+            seen += count
+
+            if count and seen >= target:
+                return self.bounds[index] if index < len(self.bounds) else self.max
+
+        return 0
+
+    def summary(self, name):
+
+        if not self.count:
+            return {"i_%s_count" % name: 0}
+
+        return {
+            "i_%s_count" % name: self.count,
+            "d_%s_mean_ms" % name: round(self.total / self.count, 3),
+            "d_%s_max_ms" % name: round(self.max, 3),
+            "d_%s_p50_bucket_ms" % name: self.percentile(50),
+            "d_%s_p95_bucket_ms" % name: self.percentile(95),
+        }
+
+
+class monitorStats:
+    def __init__(self):
+
+        self.counters = {}
+        self.histograms = {}
+
+        # hosts can be processed by a pool of workers
+        self.lock = threading.Lock()
+
+    def count(self, name, amount=1):
+
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def time(self, name, seconds):
+
+        with self.lock:
+
+            try:
+                self.histograms[name].add(seconds)
+
+            except KeyError:
+
+                self.histograms[name] = timingHistogram()
+                self.histograms[name].add(seconds)
+
+    def as_dict(self):
+
+        stats = {"i_" + name: value for name, value in self.counters.items()}
+
+        for name, histogram in self.histograms.items():
+            stats.update(histogram.summary(name))
+
+        return stats
+
+
+class rpcTarget:
+
+    # latency estimate and backoff state of one magnum address
+    __slots__ = ("srtt", "rttvar", "samples", "next", "scale", "failures", "retry_at")
+
+    def __init__(self, size=64):
+
+        self.srtt = None
+        self.rttvar = None
+        self.samples = array("d", bytes(8 * size))
+        self.next = 0
+        self.scale = 1
+        self.failures = 0
+        self.retry_at = 0
+
+    def sample(self, seconds):
+
+        # smoothed round trip and its variation, the same way tcp does it (rfc 6298)
+        if self.srtt is None:
+
+            self.srtt = seconds
+            self.rttvar = seconds / 2
+
+        else:
+
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - seconds)
+            self.srtt = 0.875 * self.srtt + 0.125 * seconds
+
+        self.samples[self.next % len(self.samples)] = seconds
+        self.next += 1
+        self.scale = 1
+
+    def expired(self):
+
+        # a call that failed or timed out doubles the timeout until the next good sample
+        self.scale = min(self.scale * 2, 16)
+
+    def timeout(self, floor, ceiling):
+
+        # room for the variation, or twice the slowest of the recent calls when that's more
+        if self.srtt is None:
+            return ceiling
+
+        recent = self.samples[: min(self.next, len(self.samples))]
+        estimate = max(self.srtt + 4 * self.rttvar, 2 * percentile(recent, 95))
+
+        return min(max(estimate * self.scale, floor), ceiling)
+
+    def allow(self):
+
+        return time.monotonic() >= self.retry_at
+
+    def failure(self, base, limit):
+
+        # every poll that fails in a row waits twice as long (with some jitter) before trying
+        self.failures += 1
+        delay = min(base * 2 ** (self.failures - 1), limit) * random.uniform(0.75, 1)
+
+        self.retry_at = time.monotonic() + delay
+
+        return delay
+
+    def success(self):
+
+        self.failures = 0
+        self.retry_at = 0
+
+
+class replaySource:
+    def __init__(self, path, loop=True, cache_size=256):
+
+        # recorded get.health.metrics answers, one per poll. a file is either a single json
+        # document (one capture, or a list of them) or json lines with one capture per line.
+        # only the start and end of each capture is found up front, a capture is parsed the
+        # first time it's replayed.
+        self.path = path
+        self.loop = loop
+        self.cache_size = cache_size
+
+        self.position = 0
+        self.frames = {}
+
+        self.file = open(path, "rb")
+
+        # gzip is known by its magic bytes, whatever the file is called
+        if self.file.read(2) == b"\x1f\x8b":
+
+            self.file.seek(0)
+            self.data = gzip.decompress(self.file.read())
+
+        else:
+
+            try:
+                self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+            except ValueError:
+
+                # an empty file can't be mapped
+                self.data = b""
+
+        match = captureStart.search(self.data)
+        start = match.start() if match else len(self.data)
+
+        if self.data[start : start + 1] == b"[":
+            self.offsets = self.index_list(start)
+
+        elif self.data[start : start + 1] == b"{" and not self.one_per_line(start):
+            self.offsets = [(start, len(self.data))]
+
+        else:
+            self.offsets = self.index_lines()
+
+    def one_per_line(self, start):
+
+        # json lines when the first line holds a whole capture, otherwise it's one document
+        # (pretty printed for instance) spread over many lines
+        end = self.data.find(b"\n", start)
+
+        if end < 0:
+            return True
+
+        try:
+            json.loads(self.data[start:end])
+
+        except ValueError:
+            return False
+
+        return True
+
+    def index_list(self, start):
+
+        # start and end of every object in the top level list, skipping over strings so a
+        # bracket inside one isn't counted
+        offsets = []
+        depth = 0
+        begin = None
+
+        for match in captureTokens.finditer(self.data, start):
+
+            token = match.group()
+
+            if token[:1] == b'"':
+                continue
+
+            if token in (b"{", b"["):
+
+                depth += 1
+
+                if depth == 2:
+                    begin = match.start()
+
+            else:
+
+                if depth == 2 and begin is not None:
+                    offsets.append((begin, match.end()))
+
+                depth -= 1
+
+                if depth == 0:
+                    break
+
+        return offsets
+
+    def index_lines(self):
+
+        # start and end of every non empty line, found without parsing any of them
+        offsets = []
+        start = 0
+        size = len(self.data)
+
+        while start < size:
+
+            end = self.data.find(b"\n", start)
+
+            if end < 0:
+                end = size
+
+            if self.data[start:end].strip():
+                offsets.append((start, end))
+
+            start = end + 1
+
+        return offsets
+
+    def __len__(self):
+
+        return len(self.offsets)
+
+    @staticmethod
+    def unwrap(frame):
+
+        # captures can hold the raw answer text with a timestamp, the rpc answer, or the metrics
+        if isinstance(frame, dict) and "frame" in frame:
+            frame = frame["frame"]
+
+        if isinstance(frame, (str, bytes)):
+            frame = json.loads(frame)
+
+        if isinstance(frame, dict) and "result" in frame:
+            frame = frame["result"]
+
+        return frame
+
+    def frame(self, index):
+
+        try:
+            return self.frames[index]
+
+        except KeyError:
+
+            start, end = self.offsets[index]
+            frame = self.unwrap(json.loads(self.data[start:end]))
+
+            if len(self.frames) >= self.cache_size:
+                self.frames.pop(next(iter(self.frames)))
+
+            self.frames[index] = frame
+
+            return frame
+
+    def next_frame(self):
+
+        # the frame for this poll, or None once a capture that doesn't loop has run out
+        if self.position >= len(self):
+
+            if not (self.loop and len(self)):
+                return None
+
+            self.position = 0
+
+        frame = self.frame(self.position)
+        self.position += 1
+
+        return frame
+
+    def close(self):
+
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+        self.file.close()
+
+
+class captureWriter:
+    def __init__(self, path, max_bytes=67108864, backups=5, queue_size=64):
+
+        # raw answers are appended as json lines {"ts": <epoch>, "frame": <answer>} by a
+        # background thread, so recording never holds up a poll. a path ending in .gz is
+        # compressed. once the file reaches max_bytes on disk it rolls over, keeping its
+        # extensions so metrics.jsonl.gz becomes metrics.1.jsonl.gz, metrics.2.jsonl.gz ..
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+
+        self.queue = queue.Queue(queue_size)
+        self.file = None
+        self.disk = None
+        self.size = 0
+        self.written = 0
+
+        self.thread = threading.Thread(target=self.run, name="magnum-capture", daemon=True)
+        self.thread.start()
+
+    def write(self, frame, timestamp=None):
+
+        # returns False when the writer has fallen behind and the frame was dropped
+        try:
+            self.queue.put_nowait((time.time() if timestamp is None else timestamp, frame))
+
+        except queue.Full:
+            return False
+
+        return True
+
+    def open(self):
+
+        # size is always what's on disk, so it's compressed bytes for a .gz capture
+        self.disk = open(self.path, "ab")
+
+        if self.path.endswith(".gz"):
+            self.file = gzip.GzipFile(fileobj=self.disk, mode="ab")
+
+        else:
+            self.file = self.disk
+
+        self.size = self.disk.tell()
+
+    def backup(self, index):
+
+        folder, name = os.path.split(self.path)
+        stem, dot, extensions = name.partition(".")
+
+        return os.path.join(folder, "%s.%s%s%s" % (stem, index, dot, extensions))
+
+    def rotate(self):
+
+        self.file.close()
+        self.disk.close()
+
+        if self.backups > 0:
+
+            for index in range(self.backups - 1, 0, -1):
+
+                source = self.backup(index)
+
+                if os.path.exists(source):
+                    os.replace(source, self.backup(index + 1))
+
+            os.replace(self.path, self.backup(1))
+
+        else:
+            os.remove(self.path)
+
+        self.open()
+
+    def run(self):
+
+        while True:
+
+            item = self.queue.get()
+
+            if item is None:
+                break
+
+            timestamp, frame = item
+
+            if isinstance(frame, (bytes, bytearray)):
+                frame = frame.decode("utf-8")
+
+            # the answer is already valid json, only line breaks between its tokens need to go
+            line = '{"ts": %r, "frame": %s}\n' % (
+                timestamp,
+                frame.strip().replace("\r", " ").replace("\n", " "),
+            )
+
+            try:
+
+                if not self.file:
+                    self.open()
+
+                elif self.size >= self.max_bytes:
+                    self.rotate()
+
+                self.file.write(line.encode("utf-8"))
+                self.file.flush()
+
+                self.size = self.disk.tell()
+                self.written += 1
+
+            except OSError as e:
+                print("capture:", e)
+
+    def close(self):
+
+        self.queue.put(None)
+        self.thread.join()
+
+        if self.file:
+
+            self.file.close()
+            self.disk.close()
+
+            self.file = None
 
 
 class processMonitor:
     def __init__(self, **kwargs):
 
-        # RPC-JSON specifics
-        self.sock = None
-        self.endFrame = (b"\x0d" + b"\x0a").decode("utf-8")
-        self.rpc_id = random.randint(1, 10)
-        self.magnum_port = 12021
+        # counters and timings for the poller itself, cheap enough to always be on
+        self.stats = monitorStats()
+        self.poller_stats = None
+
+        # RPC-JSON specifics
+        self.sock = None
+        self.endFrame = (b"\x0d" + b"\x0a").decode("utf-8")
+        self.endFrameBytes = self.endFrame.encode("utf-8")
+        self.recv_size = 262144
+        self.recv_buffer = bytearray()
+        self.rpc_id = random.randint(1, 10)
+        self.magnum_port = 12021
+        self.timeout = 2
+
+        # adaptive timeouts follow the measured rpc latency of each address, between
+        # timeout_floor and timeout. backoff stops polling an address that keeps failing for
+        # backoff_base seconds, doubling each time up to backoff_limit.
+        self.adaptive_timeout = None
+        self.timeout_floor = 0.25
+        self.backoff = None
+        self.backoff_base = 5
+        self.backoff_limit = 300
+        self.targets = {}
+
+        # bounds for discarding stale data left on the socket, and a tally of what was thrown away
+        self.drain_limit = 4194304
+        self.drain_time = 0.05
+        self.stale_bytes = 0
+        self.stale_frames = 0
+
+        # failover keeps idle connections open to each magnum server learned from the metrics,
+        # so the poll can move to one straight away when the cluster ip stops answering
+        self.failover = None
+        self.current_ip = None
+        self.server_addresses = {}
+        self.resolved = {}
+        self.active_server = None
+        self.pool = {}
+
+        # session mode negotiates the api version once per connection instead of every poll
+        self.session = True
+        self.negotiated = None
+
+        self.verbose = None
+
+        self.overall = True
+        self.top_services = 3
+
+        # history keeps this many polls of every service to add rolling averages, resident
+        # memory growth, restarts and state flaps to the service documents
+        self.history = None
+        self.service_history = {}
+
+        # restart_events emits a restart document whenever a service's pid changes. restarts
+        # are found by the service history (kept just long enough when history is off), the
+        # events are per host.
+        self.restart_events = None
+        self.restart_records = {}
+        self.clusterState = None
+        self.systemName = "Magnum"
+        self.redundancyStateServices = []
+
+        # tag_system adds the system name to the service and overall health documents too, for
+        # when the documents of several systems are merged together
+        self.tag_system = None
+        self.service_ttl = 3600
+        self.monitor_services = []
+
+        # substituted metrics come from a capture file when subdata is a path, otherwise from
+        # the named sample in api_status
+        self.substituted = None
+        self.replay = None
+        self.connect = True
+
+        # capture records every raw get.health.metrics answer to a rotating json lines file
+        self.capture = None
+        self.capture_size = 67108864
+        self.capture_files = 5
+
+        # stream mode processes each host of the metrics response as soon as it has arrived.
+        # stream_delivered is how many hosts an answer that failed part way had handed on.
+        self.stream = None
+        self.stream_delivered = 0
+
+        # workers spreads the per host processing and documents over a thread pool. the results
+        # are always merged back in the order the hosts came in.
+        self.workers = None
+        self.executor = None
+
+        # delta mode only returns documents that changed since they were last returned. numeric
+        # fields only count as changed once they move past their deadband, and everything is
+        # sent again every delta_refresh polls.
+        self.delta = None
+        self.delta_deadband = {
+            "d_cpu_p": 0.05,
+            "d_memory_p": 0.01,
+            "l_memory_b": 10000000,
+            "d_cpu_p_avg": 0.05,
+            "d_memory_p_avg": 0.01,
+            "d_memory_b_rate": 100000,
+        }
+        self.delta_refresh = 10
+        self.delta_polls = 0
+        self.previousServiceState = {}
+        self.previousRedundancyState = {}
+
+        for key, value in kwargs.items():
+
+            if ("address" in key) and (value):
+                self.magnum_ip = value
+
+            if ("services" == key) and (value):
+                self.monitor_services += value
+
+            if ("verbose" in key) and (value):
+                self.verbose = True
+
+            if ("disable_overall" in key) and (value):
+                self.overall = None
+
+            if ("disable_session" in key) and (value):
+                self.session = None
+
+            if ("poller_stats" in key) and (value):
+                self.poller_stats = True
+
+            if ("port" in key) and (value):
+                self.magnum_port = int(value)
+
+            if ("failover" in key) and (value):
+                self.failover = True
+
+            if ("adaptive_timeout" in key) and (value):
+                self.adaptive_timeout = True
+
+            if ("timeout_floor" in key) and (value):
+                self.timeout_floor = value
+
+            if ("backoff" == key) and (value):
+                self.backoff = True
+
+            if ("backoff_base" in key) and (value):
+                self.backoff_base = value
+
+            if ("backoff_limit" in key) and (value):
+                self.backoff_limit = value
+
+            if ("disable_connect" in key) and (value):
+                self.connect = None
+
+            if ("delta" == key) and (value):
+                self.delta = True
+
+            if ("delta_deadband" in key) and (value):
+                self.delta_deadband.update(value)
+
+            if ("delta_refresh" in key) and (value):
+                self.delta_refresh = value
+
+            if ("stream" in key) and (value):
+                self.stream = True
+
+            if ("workers" in key) and (value):
+                self.workers = int(value)
+
+            if ("subdata" in key) and (value):
+                self.substituted = value
+
+            if ("capture" == key) and (value):
+                self.capture = value
+
+            if ("capture_size" in key) and (value):
+                self.capture_size = int(value)
+
+            if ("capture_files" in key) and (value):
+                self.capture_files = int(value)
+
+            if ("top_services" in key) and (value):
+                self.top_services = value
+
+            if ("history" == key) and (value):
+                self.history = int(value)
+
+            if ("restart_events" in key) and (value):
+                self.restart_events = True
+
+            if ("service_ttl" in key) and (value):
+                self.service_ttl = value
+
+            if ("systemName" in key) and (value):
+                self.systemName = value
+
+            if ("tag_system" in key) and (value):
+                self.tag_system = True
+
+            if ("redundancy_services" in key) and (value):
+
+                self.redundancyStateServices = value
+
+                if "services" in kwargs.keys():
+                    self.monitor_services += value
+
+        # ordered set of the services to monitor. a dict so duplicates in the list collapse and
+        # a metric's service can be looked up instead of searched for.
+        self.service_index = dict.fromkeys(self.monitor_services)
+        self.label_cache = {}
+
+        # auto discovered services per host, and how long one is kept after it stops reporting
+        self.service_catalogue = {}
+
+        # records are kept per host and reused every poll instead of building new dicts
+        self.metric_records = {}
+        self.service_records = {}
+        self.overall_records = {}
+        self.redundancy_records = {}
+
+        # parsed cluster labels and resource values
+        self.cluster_labels = {}
+        self.cluster_values = {}
+
+        if self.capture:
+            self.capture = captureWriter(self.capture, self.capture_size, self.capture_files)
+
+        # the connection is skipped when another client (such as the bench) does the network
+        # side and only hands the metrics to build_status
+        if self.connect:
+            self.rpc_connect()
+
+    def do_ping(self):
+
+        ping_def = {"id": self.rpcId(), "jsonrpc": "2.0", "method": "ping"}
+
+        ping_payload = json.dumps(ping_def) + self.endFrame
+
+        resp = self.rpc_call(ping_payload, "ping")
+
+        try:
+
+            if resp["result"] == "pong":
+                return True
+
+        except Exception:
+            return None
+
+    def set_version(self):
+
+        version_def = {
+            "id": self.rpcId(),
+            "jsonrpc": "2.0",
+            "method": "health.api.handshake",
+            "params": {"client_supported_versions": [2]},
+        }
+
+        version_payload = json.dumps(version_def) + self.endFrame
+
+        resp = self.rpc_call(version_payload, "health.api.handshake")
+
+        try:
+
+            if resp["result"]["server_selected_version"] == 2:
+                return True
+
+        except Exception:
+            return None
+
+    def negotiate(self):
+
+        # ping and agree on version 2 of the health api. in session mode the result
+        # is remembered until the connection is closed or a request gets rejected.
+        if self.do_ping() and self.set_version():
+
+            self.negotiated = True if self.session else None
+
+            return True
+
+        self.negotiated = None
+
+        return None
+
+    def get_metrics(self, handler=None):
+
+        # with a handler the response is streamed, see rpc_stream
+
+        metrics_def = {"id": self.rpcId(), "jsonrpc": "2.0", "method": "get.health.metrics"}
+
+        metrics_payload = json.dumps(metrics_def) + self.endFrame
+
+        if self.failover:
+
+            # head back to the cluster ip once it's answering again. this goes before the pool is
+            # topped up, only a connect started on an earlier poll has had time to complete.
+            if self.current_ip != self.magnum_ip:
+                self.rpc_failover([self.magnum_ip])
+
+            self.warm_pool()
+
+        # an address that's backing off costs nothing until it's time to try it again
+        if self.backoff and not self.target().allow():
+
+            if not (self.failover and self.rpc_failover()):
+
+                self.stats.count("backoff_skips")
+
+                return None
+
+        # a connect that was skipped while the address was backing off left nothing to retry on
+        if not (self.negotiated or self.connected()):
+
+            if not (self.failover and self.rpc_failover()):
+                self.rpc_connect()
+
+        metrics = self.try_metrics(metrics_payload, handler)
+
+        if self.backoff:
+
+            if metrics is None:
+
+                delay = self.target().failure(self.backoff_base, self.backoff_limit)
+
+                if self.verbose:
+                    print("backing off %s for %.1fs" % (self.current_ip, delay))
+
+            else:
+                self.target().success()
+
+        return metrics
+
+    def try_metrics(self, metrics_payload, handler):
+
+        retries = 2
+        while retries > 0:
+
+            if self.negotiated or self.negotiate():
+
+                if handler:
+
+                    results = self.rpc_stream(metrics_payload, handler, "get.health.metrics")
+
+                    if results is not None:
+                        return results
+
+                    # the hosts of an answer that was cut off have already been handed on and a
+                    # retry would process them a second time, so only reconnect for next poll
+                    if self.stream_delivered:
+
+                        self.stats.count("stream_cutoffs")
+                        retries = 1
+
+                else:
+
+                    resp = self.rpc_call(metrics_payload, "get.health.metrics")
+
+                    try:
+
+                        if "result" in resp:
+                            return resp["result"]
+
+                    except Exception:
+                        pass
+
+            # socket error or the server rejected the request, renegotiate on a fresh connection.
+            # a warm connection to another server beats reconnecting to the one that just failed.
+            self.negotiated = None
+            self.stats.count("retries")
+
+            if not (self.failover and self.rpc_failover()):
+
+                self.stats.count("reconnects")
+
+                self.rpc_close()
+                self.rpc_connect()
+
+            retries -= 1
+
+        return None
+
+    def rpc_call(self, msg, method="rpc"):
+
+        start = time.perf_counter()
+
+        try:
+
+            if self.adaptive_timeout:
+                self.sock.settimeout(self.rpc_timeout())
+
+            self.drain_socket()
+            self.sock.sendall(msg.encode("utf-8"))
+
+            frame = self.read_frame().decode("utf-8")
+            response = json.loads(frame)
+
+        except Exception:
+
+            # a partial frame can't be resumed once the call has been given up on
+            self.recv_buffer.clear()
+
+            self.stats.count("rpc_errors")
+            self.rpc_measured(None)
+
+            return None
+
+        self.stats.time("rpc_" + method.replace(".", "_"), time.perf_counter() - start)
+        self.rpc_measured(time.perf_counter() - start)
+
+        if self.capture and method == "get.health.metrics":
+            self.capture_frame(frame)
+
+        if self.verbose:
+            print("-->", msg.strip("\r\n"))
+            print("<--", json.dumps(response)[0:300])
+            print(json.dumps(response, indent=1))
+
+        return response
+
+    def rpc_stream(self, msg, handler, method="rpc"):
+
+        # send a request and parse the result object while it arrives. each entry is handed to
+        # handler(key, value) as soon as it's complete, so only the entry being received is held
+        # in memory. returns the list of handler results, or None if there was no result.
+        start = time.perf_counter()
+
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        text = ""
+        pos = 0
+        depth = 0
+
+        field = None
+        key = None
+        in_result = False
+        has_result = False
+        value_start = None
+        frame_end = None
+
+        results = []
+        self.stream_delivered = 0
+
+        # everything received is only held on to when it's being captured
+        received = [] if self.capture and method == "get.health.metrics" else None
+
+        try:
+
+            if self.adaptive_timeout:
+                self.sock.settimeout(self.rpc_timeout())
+
+            self.drain_socket()
+            self.sock.sendall(msg.encode("utf-8"))
+
+            # the frame is done once the top level object has closed and the terminator is in
+            while frame_end is None or self.endFrame not in text[frame_end:]:
+
+                data = self.sock.recv(self.recv_size)
+
+                if not data:
+                    raise ConnectionError("connection closed by %s" % self.magnum_ip)
+
+                self.stats.count("bytes_received", len(data))
+
+                text += decoder.decode(data)
+
+                if received is not None:
+                    received.append(data)
+
+                while frame_end is None:
+
+                    match = streamTokens.search(text, pos)
+
+                    if not match:
+                        pos = len(text)
+                        break
+
+                    token = match.group()
+
+                    # string cut off by the end of the data so far
+                    if token == '"':
+                        pos = match.start()
+                        break
+
+                    pos = match.end()
+
+                    if token[0] == '"':
+
+                        # keys of the top level object, and of the result object
+                        if depth == 1:
+                            field = token
+
+                        elif depth == 2 and in_result:
+                            key = token
+
+                    elif token in "{[":
+
+                        depth += 1
+
+                        if depth == 2:
+                            in_result = token == "{" and field == '"result"'
+                            has_result = has_result or in_result
+
+                        elif depth == 3 and in_result:
+
+                            # usually the whole entry is already here and can be decoded in one
+                            # go, otherwise keep scanning until its closing brace arrives
+                            try:
+
+                                value, pos = jsonDecoder.raw_decode(text, match.start())
+
+                                results.append(handler(json.loads(key), value))
+
+                                depth -= 1
+
+                            except ValueError:
+                                value_start = match.start()
+
+                    else:
+
+                        depth -= 1
+
+                        if depth == 2 and value_start is not None:
+
+                            results.append(
+                                handler(json.loads(key), json.loads(text[value_start:pos]))
+                            )
+
+                            value_start = None
+
+                        elif depth == 0:
+                            frame_end = pos
+
+                # let go of everything already scanned unless an entry is still arriving
+                if frame_end is None:
+
+                    cut = pos if value_start is None else value_start
+
+                    text = text[cut:]
+                    pos -= cut
+
+                    if value_start is not None:
+                        value_start = 0
+
+            # anything past the terminator belongs to the next frame
+            rest = text[frame_end:]
+            self.recv_buffer += rest[rest.index(self.endFrame) + len(self.endFrame) :].encode(
+                "utf-8"
+            )
+
+        except (OSError, ValueError, AttributeError):
+
+            self.recv_buffer.clear()
+
+            self.stats.count("rpc_errors")
+            self.rpc_measured(None)
+
+            self.stream_delivered = len(results)
+
+            return None
+
+        self.stats.time("rpc_" + method.replace(".", "_"), time.perf_counter() - start)
+        self.rpc_measured(time.perf_counter() - start)
+
+        if received is not None:
+
+            # the frame is everything received except what already belongs to the next one
+            received = b"".join(received)
+            self.capture_frame(received[: len(received) - len(self.recv_buffer)])
+
+        return results if has_result else None
+
+    def capture_frame(self, frame):
+
+        if self.capture.write(frame):
+            self.stats.count("captured")
+
+        else:
+            self.stats.count("capture_dropped")
+
+    def drain_socket(self):
+
+        # throw away anything a previous call left behind (buffered frames or late responses
+        # still on the socket) so the next frame read belongs to the next request. reads are
+        # non-blocking and capped by size and time so a chatty socket can't stall the poll.
+        discarded = len(self.recv_buffer)
+        frames = self.recv_buffer.count(self.endFrameBytes)
+        self.recv_buffer.clear()
+
+        inputready, _, _ = select.select([self.sock], [], [], 0)
+
+        if inputready:
+
+            timeout = self.sock.gettimeout()
+            deadline = time.monotonic() + self.drain_time
+            last = b""
+
+            try:
+
+                self.sock.settimeout(0)
+
+                while discarded < self.drain_limit and time.monotonic() < deadline:
+
+                    try:
+                        data = self.sock.recv(self.recv_size)
+                    except (BlockingIOError, socket.timeout):
+                        break
+
+                    # peer closed, the request that follows will fail and trigger a reconnect
+                    if not data:
+                        break
+
+                    # count terminators, including one split across two reads
+                    frames += data.count(self.endFrameBytes)
+                    if last + data[:1] == self.endFrameBytes:
+                        frames += 1
+
+                    last = data[-1:]
+                    discarded += len(data)
+
+            finally:
+                self.sock.settimeout(timeout)
+
+        if discarded:
+
+            self.stale_bytes += discarded
+            self.stale_frames += frames
+
+            self.stats.count("stale_bytes", discarded)
+            self.stats.count("stale_frames", frames)
+
+            if self.verbose:
+                print("discarded %s stale bytes (%s frames)" % (discarded, frames))
+
+        return discarded
+
+    def read_frame(self):
+
+        # collect bytes into one buffer until a complete frame has arrived. the search resumes
+        # just before the old end of the buffer so a terminator split across two reads is found.
+        # anything received past the terminator stays buffered for the next frame.
+        buffer = self.recv_buffer
+        start = 0
+
+        while True:
+
+            index = buffer.find(self.endFrameBytes, start)
+
+            if index >= 0:
+
+                frame = bytes(buffer[:index])
+                del buffer[: index + len(self.endFrameBytes)]
+
+                return frame
+
+            start = max(len(buffer) - len(self.endFrameBytes) + 1, 0)
+
+            data = self.sock.recv(self.recv_size)
+
+            if not data:
+                raise ConnectionError("connection closed by %s" % self.magnum_ip)
+
+            self.stats.count("bytes_received", len(data))
+
+            buffer += data
+
+    def rpc_connect(self):
+
+        self.negotiated = None
+        self.recv_buffer.clear()
+
+        if self.backoff and not self.target(self.magnum_ip).allow():
+            return None
+
+        try:
+
+            self.current_ip = self.magnum_ip
+
+            start = time.perf_counter()
+
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.settimeout(self.rpc_timeout())
+            self.sock.connect((self.magnum_ip, self.magnum_port))
+
+            # the connect histogram counts them too (i_connect_count)
+            self.stats.time("connect", time.perf_counter() - start)
+
+            return True
+
+        except Exception:
+
+            self.stats.count("connect_errors")
+
+            self.rpc_close()
+
+        return None
+
+    def connected(self):
+
+        # a socket that was closed (or never connected) has no peer
+        try:
+
+            self.sock.getpeername()
+
+            return True
+
+        except Exception:
+            return None
+
+    def rpc_close(self):
+
+        self.negotiated = None
+
+        try:
+
+            self.sock.shutdown(socket.SHUT_RDWR)
+            self.sock.close()
+
+            return True
+
+        except Exception:
+            return None
+
+    def warm_pool(self):
+
+        # drop pooled connections that failed or were closed by the server. an idle connection
+        # should never have anything to read, so readable means closed (or out of sync).
+        for address, sock in list(self.pool.items()):
+
+            try:
+
+                readable, writable, _ = select.select([sock], [sock], [], 0)
+
+                if readable or (
+                    writable and sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) != 0
+                ):
+                    raise ConnectionError
+
+            except Exception:
+
+                self.pool.pop(address, None)
+                sock.close()
+
+        # start a non-blocking connect to every learned server (and the cluster ip when polling
+        # from somewhere else) that doesn't have a connection yet, so nothing waits on a connect
+        for address in [self.magnum_ip] + list(self.server_addresses.values()):
+
+            if address == self.current_ip or address in self.pool:
+                continue
+
+            # a hostname is only looked up once, connect_ex would block on it every poll
+            target = self.resolve(address)
+
+            if not target:
+                continue
+
+            try:
+
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.setblocking(False)
+
+                if sock.connect_ex((target, self.magnum_port)) not in (
+                    0,
+                    errno.EINPROGRESS,
+                    errno.EWOULDBLOCK,
+                ):
+                    sock.close()
+                    continue
+
+                self.pool[address] = sock
+
+            except Exception:
+                pass
+
+    def resolve(self, address):
+
+        # ip address of a pooled server, looked up the first time it's seen. a name that
+        # doesn't resolve stays None and is left out of the pool.
+        try:
+            return self.resolved[address]
+
+        except KeyError:
+
+            resolved = address
+
+            try:
+                ipaddress.ip_address(address)
+
+            except ValueError:
+
+                try:
+                    resolved = socket.gethostbyname(address)
+
+                except OSError:
+                    resolved = None
+
+            self.resolved[address] = resolved
+
+            return resolved
+
+    def rpc_failover(self, addresses=None):
+
+        # the active server goes first, it's the one the cluster ip will be moving to
+        if addresses is None:
+
+            addresses = [self.server_addresses.get(self.active_server), self.magnum_ip]
+            addresses += list(self.server_addresses.values())
+
+        for address in addresses:
+
+            sock = self.pool.pop(address, None)
+
+            if not sock:
+                continue
+
+            try:
+
+                readable, writable, _ = select.select([sock], [sock], [], 0)
+
+                # a connect still in progress stays pooled for the next poll
+                if not (readable or writable):
+
+                    self.pool[address] = sock
+
+                    continue
+
+                # only use it once the connect has completed without error. an idle connection
+                # that's readable was closed by the server.
+                if not readable and sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+
+                    self.rpc_close()
+
+                    self.sock = sock
+                    self.current_ip = address
+
+                    sock.settimeout(self.rpc_timeout())
+                    self.recv_buffer.clear()
+
+                    self.stats.count("failovers")
+
+                    if self.verbose:
+                        print("failover to", address)
+
+                    return True
+
+            except Exception:
+                pass
+
+            sock.close()
+
+        return None
+
+    def dispose(self):
+
+        self.rpc_close()
+
+        for sock in self.pool.values():
+            sock.close()
+
+        self.pool.clear()
+
+        if self.executor:
+
+            self.executor.shutdown()
+            self.executor = None
+
+        if isinstance(self.replay, replaySource):
+            self.replay.close()
+
+        self.replay = None
+
+        if isinstance(self.capture, captureWriter):
+            self.capture.close()
+
+        self.capture = None
+
+    def target(self, address=None):
+
+        address = address or self.current_ip or self.magnum_ip
+
+        try:
+            return self.targets[address]
+
+        except KeyError:
+            target = self.targets[address] = rpcTarget()
+
+        return target
+
+    def rpc_timeout(self):
+
+        if self.adaptive_timeout:
+            return self.target().timeout(self.timeout_floor, self.timeout)
+
+        return self.timeout
+
+    def rpc_measured(self, seconds):
+
+        # only answered calls are a latency sample, anything else widens the timeout
+        if self.adaptive_timeout:
+
+            target = self.target()
+
+            if seconds is None:
+                target.expired()
+
+            else:
+                target.sample(seconds)
+
+    def rpcId(self):
+
+        self.rpc_id = random.randint(1, 10) if self.rpc_id > 99 else self.rpc_id + 1
+
+        return self.rpc_id
+
+    def parse_label(self, label):
+
+        # labels repeat every poll, so each one is only parsed the first time it's seen.
+        # returns the service of a "Services: <name> ..." label (or the words of any other
+        # label) along with the kind of metric it is.
+        try:
+            return self.label_cache[label]
+
+        except KeyError:
+
+            match = serviceLabel.search(label)
+            kind = next((kind for text, kind in metricKinds if text in label), None)
+
+            if match:
+                parsed = (match.group(1), (), kind)
+
+            else:
+                parsed = (None, tuple(labelWords.findall(label)), kind)
+
+            # labels are a fixed set per system, the cap only guards against something odd
+            if len(self.label_cache) > 100000:
+                self.label_cache.clear()
+
+            self.label_cache[label] = parsed
+
+            return parsed
+
+    def metric_service(self, label, services):
+
+        # a "Services: <name> ..." label only ever belongs to <name>, any other label is
+        # matched on whole words so short service names don't match inside longer ones.
+        service, words, _ = self.parse_label(label)
+
+        if service:
+            return service if service in services else None
+
+        for word in words:
+            if word in services:
+                return word
+
+        return None
+
+    def create_service_dict(self):
+
+        return {service: [] for service in self.service_index}
+
+    def autogenerate_service_dict(self, hostname, metric_list):
+
+        # the discovered services are kept per host between polls with the time each was
+        # last seen. new labels add to it, services that stop reporting are aged out.
+        now = time.monotonic()
+        catalogue = self.service_catalogue.setdefault(hostname, {})
+
+        for metric in metric_list:
+
+            service = self.parse_label(metric[0])[0]
+
+            if service:
+                catalogue[service] = now
+
+        for service, seen in list(catalogue.items()):
+            if now - seen > self.service_ttl:
+                del catalogue[service]
+
+        return {service: [] for service in catalogue}
+
+    def group_host(self, address, hostCollection):
+
+        # split one host's metric list into its services and cluster information
+        hostname = hostCollection["hostname"]
+
+        self.stats.count("metrics", len(hostCollection["health_metrics"]))
+
+        # remember where each server lives for the failover pool. use the collection key
+        # when it's an ip address, otherwise fall back to the hostname.
+        if self.failover:
+
+            try:
+                ipaddress.ip_address(address)
+
+            except ValueError:
+                address = hostname
+
+            self.server_addresses[hostname] = address
+
+        # generate a nested service tree by either the class service list or call the
+        # auto generating function to discovery all the services from the metrics list.
+        host_processes = (
+            self.create_service_dict()
+            if len(self.monitor_services) > 0
+            else self.autogenerate_service_dict(hostname, hostCollection["health_metrics"])
+        )
+
+        host_cluster = []
+
+        # metric records of the host by label, anything that stopped reporting is let go
+        records = self.metric_records.get(hostname, {})
+        host_records = {}
+
+        for metric in hostCollection["health_metrics"]:
+
+            label = metric[0]
+
+            # a label repeated within the same poll gets a record of its own
+            record = records.get(label) if label not in host_records else None
+
+            if record is None:
+                record = metricRecord(label, self.parse_label(label)[2])
+
+            record.value = metric[1]
+            record.status = metric[2]
+
+            host_records.setdefault(label, record)
+
+            # look up which service the metric desciption belongs to (if any)
+            service = self.metric_service(label, host_processes)
+
+            if service:
+                host_processes[service].append(record)
+
+            if "Cluster" in label:
+                host_cluster.append(record)
+
+        self.metric_records[hostname] = host_records
+
+        return (
+            hostname,
+            {"processes": host_processes, "overall_health": hostCollection["overall_health"]},
+            {"cluster_information": host_cluster},
+        )
+
+    def group_metrics(self, metrics):
+
+        if metrics:
+
+            process_metrics = {}
+            cluster_information = {}
+
+            for address, hostCollection in metrics.items():
+
+                host, host_processes, host_cluster = self.group_host(address, hostCollection)
+
+                process_metrics.update({host: host_processes})
+                cluster_information.update({host: host_cluster})
+
+            if self.verbose:
+                print(json.dumps(process_metrics, indent=1, default=recordJSON))
+                print(json.dumps(cluster_information, indent=1, default=recordJSON))
+
+            return process_metrics, cluster_information
+
+        return None, None
+
+    def create_status(self):
+
+        if self.stream and not self.substituted:
+
+            # hosts are grouped and processed while the rest of the response is still arriving
+            start = time.perf_counter()
+
+            if self.workers:
+
+                # each host is handed to the pool as it arrives and collected in arrival order
+                submitted = []
+
+                def submit(address, hostCollection):
+
+                    future = self.host_pool().submit(self.process_host, address, hostCollection)
+                    submitted.append(future)
+
+                    return future
+
+                futures = self.get_metrics(submit)
+
+                # hosts of an answer that was cut off are still waited on, so they're done with
+                # the records before the next poll starts
+                hosts = [future.result() for future in (futures or submitted)]
+
+                return self.finish_status(hosts if futures else None, start)
+
+            return self.finish_status(self.get_metrics(self.process_host), start)
+
+        if not self.substituted:
+
+            sample_metrics = self.get_metrics()
+
+        else:
+
+            try:
+
+                sample_metrics = self.replay_metrics()
+
+            except Exception as e:
+                print(e)
+                quit()
+
+        return self.build_status(sample_metrics)
+
+    def replay_metrics(self):
+
+        if not self.replay:
+
+            if os.path.isfile(self.substituted):
+                self.replay = replaySource(self.substituted)
+
+            else:
+                self.replay = getattr(importlib.import_module("api_status"), self.substituted)
+
+        if isinstance(self.replay, replaySource):
+            return self.replay.next_frame()
+
+        return self.replay
+
+    def host_redundancy(self, host, cluster_collection):
+
+        # calculate redundancy status information
+        try:
+            redundancy = self.redundancy_records[host]
+
+        except KeyError:
+            redundancy = self.redundancy_records[host] = redundancyRecord()
+
+        redundancy.reset()
+
+        redundancy.s_host = host
+        redundancy.s_system = self.systemName
+
+        # status list is used to store the state of each cluster ip resource to be verified later
+        clusterStatus = []
+
+        for item in cluster_collection["cluster_information"]:
+
+            # labels and values repeat every poll so they're only parsed the first time
+            try:
+                kind, name, token = self.cluster_labels[item.label]
+
+            except KeyError:
+                kind, name, token = parse_cluster_label(item.label)
+                self.cluster_labels[item.label] = (kind, name, token)
+
+            if kind == "maintenance":
+                redundancy.s_maintenance = item.value
+
+            # some older magnum code uses this format (1.17.2), item.value = Yes/No
+            elif kind == "online" and name == host:
+                redundancy.s_online = item.value
+
+            # newer magnum code uses this format (versions TBD), item.value = Online/Offline
+            elif kind == "server" and name == host:
+                redundancy.s_online = item.value
+
+            elif token:
+                clusterStatus.append(item.value)
+
+            if kind == "resource":
+
+                try:
+                    role, node, running = self.cluster_values[item.value]
+
+                except KeyError:
+
+                    if len(self.cluster_values) > 10000:
+                        self.cluster_values.clear()
+
+                    role, node, running = parse_cluster_value(item.value)
+                    self.cluster_values[item.value] = (role, node, running)
+
+                redundancy.resources.append(clusterResource(name, node, role, running))
+
+                if running:
+                    redundancy.i_resources_running += 1
+
+                else:
+                    redundancy.i_resources_stopped += 1
+
+        # calculate redundancy status description. if server is offline then punt out a Server Error Offline
+        # if both token and ip1 is started or stopped then assume it's working Active or Standby
+        # if both do not match than assume there's a server error. probably need to add more combinations in the future.
+
+        # Yes = old version (~1.17.2), Online = newer versions...
+        if redundancy.s_online == "Yes" or redundancy.s_online == "Online":
+
+            if all(status == "Started" for status in clusterStatus):
+                redundancy.s_status = "Server Active/Online"
+                self.active_server = host
+
+            elif all(status == "Stopped" for status in clusterStatus):
+                redundancy.s_status = "Server Standby/Online"
+
+            else:
+                redundancy.s_status = "Server Error Online"
+
+        else:
+            redundancy.s_status = "Server Error Offline"
+
+        return redundancy
+
+    def host_services(self, host, host_collection, redundancy):
+
+        # get all the process state and information for the host
+        services = {}
+
+        records = self.service_records.setdefault(host, {})
+
+        # let go of the records of services that are no longer monitored (or discovered)
+        if len(records) > len(host_collection["processes"]):
+
+            for service in list(records.keys()):
+                if service not in host_collection["processes"]:
+                    del records[service]
+                    self.service_history.pop((host, service), None)
+
+        # redundancy services read as "Standby" when the server is a normal standby.
+        standby = redundancy.s_status == "Server Standby/Online"
+
+        system = self.systemName if self.tag_system else None
+
+        now = time.monotonic()
+
+        if self.restart_events:
+            self.restart_records[host] = []
+
+        for service, metrics in host_collection["processes"].items():
+
+            # reset to the default set of information that is a missing metric for easy fallback
+            try:
+                service_def = records[service]
+
+            except KeyError:
+                service_def = records[service] = serviceRecord()
+
+            service_def.reset()
+            service_def.s_service = service
+            service_def.s_system = system
+
+            services[service] = service_def
+
+            # iterate through each of the list items for a process
+            for metric in metrics:
+
+                kind = metric.kind
+
+                if kind == "state":
+
+                    # set value as-is
+                    service_def.s_state = metric.value
+
+                    # set the id to 1 if string is running, otherwise just use 0.
+                    service_def.i_id = 1 if metric.value == "Running" else 0
+
+                    # chech if it's "Not Running" or "Stopped" while the server redundancy is known to be in a normal Standby/Online state
+                    # and the service is known as a redundancy state service, then rewrite the state as "Standby"
+                    # otherwise just leave the value as-is.
+                    if (
+                        standby
+                        and (metric.value == "Not Running" or metric.value == "Stopped")
+                        and service in self.redundancyStateServices
+                    ):
+
+                        service_def.s_state = "Standby"
+                        service_def.i_id = 2
+
+                elif kind:
+
+                    field, parser = metricParsers[kind]
+                    setattr(service_def, field, parser(metric.value))
+
+                # set status to value if not set or anytime if value is not "Ok"
+                # trying to get any unkown values to stay set that's worse than "OK"
+                if (metric.status != "Ok") or not service_def.s_status:
+                    service_def.s_status = metric.status
+
+            if self.history or self.restart_events:
+                self.service_trend(host, service, service_def, now)
+
+        # create overall metrics if the flag is left on
+        if self.overall:
+
+            # reset to the default information for overall health
+            # state comes from the magnum overall health state.
+            try:
+                overall_health = self.overall_records[host]
+
+            except KeyError:
+                overall_health = self.overall_records[host] = overallRecord()
+
+            overall_health.reset()
+            overall_health.s_status = host_collection["overall_health"]
+            overall_health.s_system = system
+
+            names = []
+            cpu = array("d")
+            memory = array("d")
+            resident = array("q")
+
+            for service, metrics in services.items():
+
+                names.append(service)
+                cpu.append(metrics.d_cpu_p)
+                memory.append(metrics.d_memory_p)
+                resident.append(metrics.l_memory_b)
+
+                if metrics.s_state != "Running" and metrics.s_state != "Standby":
+                    overall_health.s_state = "Not Running"
+                    overall_health.i_num_failed += 1
+
+            overall_health.i_num_services = len(names)
+            overall_health.rollup(names, cpu, memory, resident, self.top_services)
+
+            services["overall_health"] = overall_health
+
+        return services
+
+    def service_trend(self, host, service, record, now):
+
+        try:
+            history = self.service_history[(host, service)]
+
+        except KeyError:
+            history = self.service_history[(host, service)] = serviceHistory(self.history or 2)
+
+        previous = history.add(now, record)
+
+        if self.history:
+            history.update(record)
+
+        if self.restart_events and previous is not None:
+            self.service_restart(host, service, record, previous, history.since)
+
+    def service_restart(self, host, service, record, previous, since):
+
+        event = restartRecord()
+
+        event.s_service = service
+        event.i_pid = record.i_pid
+        event.i_previous_pid = previous
+        event.d_since_restart_s = round(since, 3) if since is not None else None
+        event.s_state = record.s_state
+        event.s_system = self.systemName
+
+        self.restart_records[host].append(event)
+        self.stats.count("restarts")
+
+    def process_host(self, address, hostCollection):
+
+        # grouping, redundancy and service state for a single host. returns the seconds spent
+        # grouping so a poll can account for it no matter how hosts are handed in.
+        start = time.perf_counter()
+
+        host, host_processes, host_cluster = self.group_host(address, hostCollection)
+
+        grouped = time.perf_counter() - start
+
+        if self.verbose:
+            print(json.dumps({host: host_processes}, indent=1, default=recordJSON))
+            print(json.dumps({host: host_cluster}, indent=1, default=recordJSON))
+
+        redundancy = self.host_redundancy(host, host_cluster)
+        services = self.host_services(host, host_processes, redundancy)
+
+        return host, services, redundancy, grouped
+
+    def host_pool(self):
+
+        if not self.executor:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers)
+
+        return self.executor
+
+    def build_status(self, metrics):
+
+        start = time.perf_counter()
+
+        if self.workers and metrics and len(metrics) > 1:
+
+            # map keeps the hosts in order no matter which worker finishes first
+            hosts = list(
+                self.host_pool().map(
+                    lambda item: self.process_host(*item), list(metrics.items())
+                )
+            )
+
+        else:
+
+            hosts = [
+                self.process_host(address, hostCollection)
+                for address, hostCollection in (metrics.items() if metrics else [])
+            ]
+
+        return self.finish_status(hosts, start)
+
+    def finish_status(self, hosts, start):
+
+        # merge the per host results (in order) into the service and redundancy state
+        redundancyState = None
+        serviceState = None
+
+        if hosts:
+
+            redundancyState = {}
+            serviceState = {}
+
+            for host, services, redundancy, _ in hosts:
+
+                redundancyState.update({host: redundancy})
+                serviceState.update({host: services})
+
+            self.resource_locations(redundancyState)
+
+            if self.overall:
+                self.cluster_rollup(serviceState)
+
+            if self.verbose:
+                print(json.dumps(redundancyState, indent=1, default=recordJSON))
+                print(json.dumps(serviceState, indent=1, default=recordJSON))
+
+        self.stats.time("group_metrics", sum(host[3] for host in hosts) if hosts else 0)
+        self.stats.time("create_status", time.perf_counter() - start)
+        self.stats.count("polls")
+
+        if self.delta:
+            return self.delta_status(serviceState, redundancyState)
+
+        return serviceState, redundancyState
+
+    def resource_locations(self, redundancyState):
+
+        # where each resource is running across the cluster. a node named in the value is used
+        # when it's one of the hosts, otherwise it's the host reporting the resource as running.
+        running = {}
+
+        for host, redundancy in redundancyState.items():
+
+            for resource in redundancy.resources:
+
+                if resource.running:
+                    running.setdefault(
+                        resource.name, resource.node if resource.node in redundancyState else host
+                    )
+
+        # resources stopped on a host with where they run instead, and any not running anywhere
+        for host, redundancy in redundancyState.items():
+
+            stopped = []
+            failed = []
+
+            for resource in redundancy.resources:
+
+                if not resource.running:
+
+                    node = running.get(resource.name)
+
+                    stopped.append("%s (%s)" % (resource.name, node or "not running"))
+
+                    if not node:
+                        failed.append(resource.name)
+
+            redundancy.s_resources_stopped = ", ".join(stopped) or None
+            redundancy.s_resources_failed = ", ".join(failed) or None
+
+    def cluster_rollup(self, serviceState):
+
+        # system wide overall health across every host, with the busiest services by host
+        if not self.clusterState:
+            self.clusterState = clusterRecord()
+
+        cluster = self.clusterState
+
+        cluster.reset()
+        cluster.s_system = self.systemName
+
+        names = []
+        cpu = array("d")
+        memory = array("d")
+        resident = array("q")
+
+        for host, services in serviceState.items():
+
+            cluster.i_num_hosts += 1
+
+            for service, metrics in services.items():
+
+                if service == "overall_health":
+
+                    cluster.i_num_failed += metrics.i_num_failed
+
+                    # the worst magnum overall health of the hosts
+                    if metrics.s_status != "Ok" or not cluster.s_status:
+                        cluster.s_status = metrics.s_status
+
+                    continue
+
+                names.append("%s %s" % (host, service))
+                cpu.append(metrics.d_cpu_p)
+                memory.append(metrics.d_memory_p)
+                resident.append(metrics.l_memory_b)
+
+        if cluster.i_num_failed:
+            cluster.s_state = "Not Running"
+
+        cluster.i_num_services = len(names)
+        cluster.rollup(names, cpu, memory, resident, self.top_services)
+
+        return cluster
+
+    def documents_json(self, serviceState, redundancyState, restarts=True):
+
+        # inSITE poller documents from the status information, written as json text in one pass
+        # straight from the records. restarts=None leaves the restart documents out, for a
+        # caller that delivers them itself (see restart_json).
+        parts = []
+        documents = 0
+
+        if serviceState:
+
+            if self.workers and len(serviceState) > 1:
+                parts.extend(self.host_pool().map(self.host_json, list(serviceState.items())))
+
+            else:
+                parts.extend(self.host_json(item) for item in serviceState.items())
+
+            # a host without services has nothing to join
+            parts = [part for part in parts if part]
+
+            documents += sum(len(processes) for processes in serviceState.values())
+
+        if redundancyState:
+
+            for server, info in redundancyState.items():
+
+                tail = ', "host": %s, "name": "redundancy"}' % encodeValue(server)
+
+                parts.append('{"fields": ' + info.to_json() + tail)
+                documents += 1
+
+        if serviceState and self.clusterState:
+
+            tail = ', "host": %s, "name": "cluster"}' % encodeValue(self.systemName)
+
+            parts.append('{"fields": ' + self.clusterState.to_json() + tail)
+            documents += 1
+
+        if restarts:
+
+            events = self.restart_json(serviceState)
+
+            parts.extend(events)
+            documents += len(events)
+
+        self.stats.count("documents", documents)
+
+        if self.poller_stats:
+
+            document = {"fields": self.get_stats(), "host": self.magnum_ip, "name": "poller_stats"}
+
+            parts.append(json.dumps(document))
+
+        return "[" + ", ".join(parts) + "]"
+
+    def restart_json(self, serviceState):
+
+        # the restart documents of the hosts polled, a list of json text
+        parts = []
+
+        if serviceState and self.restart_events:
+
+            for server in serviceState.keys():
+
+                tail = ', "host": %s, "name": "restart"}' % encodeValue(server)
+
+                for event in self.restart_records.get(server, ()):
+                    parts.append('{"fields": ' + event.to_json() + tail)
+
+        return parts
+
+    def host_json(self, item):
+
+        # the service documents of a single host, already joined
+        server, processes = item
+
+        tail = ', "host": %s, "name": "service"}' % encodeValue(server)
+
+        return ", ".join('{"fields": ' + metrics.to_json() + tail for metrics in processes.values())
+
+    def get_stats(self):
+
+        stats = self.stats.as_dict()
+
+        stats.update(
+            {
+                "s_system": self.systemName,
+                "s_current_ip": self.current_ip,
+                "d_rpc_timeout_s": round(self.rpc_timeout(), 3),
+                "d_backoff_s": round(max(self.target().retry_at - time.monotonic(), 0), 3),
+                "s_type": "poller_stats",
+            }
+        )
+
+        return {key: value for key, value in stats.items() if value is not None}
+
+    def changed(self, previous, document):
+
+        if previous is None:
+            return True
+
+        for key, value in document.items():
+
+            if key in self.delta_deadband:
+
+                try:
+
+                    if abs(value - previous[key]) > self.delta_deadband[key]:
+                        return True
+
+                except Exception:
+
+                    if value != previous.get(key):
+                        return True
+
+            elif value != previous.get(key):
+                return True
+
+        return False
+
+    def delta_status(self, serviceState, redundancyState):
+
+        # a full refresh on the first poll and every delta_refresh polls after that
+        refresh = self.delta_polls % self.delta_refresh == 0
+        self.delta_polls += 1
+
+        if serviceState:
+
+            for host, services in serviceState.items():
 
-        self.verbose = None
+                previous = self.previousServiceState.setdefault(host, {})
 
-        self.overall = True
-        self.systemName = "Magnum"
-        self.redundancyStateServices = []
-        self.monitor_services = []
+                for service, document in list(services.items()):
 
-        self.substituted = None
+                    if refresh or self.changed(previous.get(service), document):
 
-        for key, value in kwargs.items():
+                        # keep a copy, the caller is free to modify what gets returned
+                        previous[service] = dict(document)
 
-            if ("address" in key) and (value):
-                self.magnum_ip = value
+                    else:
+                        del services[service]
 
-            if ("services" == key) and (value):
-                self.monitor_services += value
+        if redundancyState:
 
-            if ("verbose" in key) and (value):
-                self.verbose = True
+            for host, document in list(redundancyState.items()):
 
-            if ("disable_overall" in key) and (value):
-                self.overall = None
+                if refresh or self.changed(self.previousRedundancyState.get(host), document):
+                    self.previousRedundancyState[host] = dict(document)
 
-            if ("subdata" in key) and (value):
-                self.substituted = value
+                else:
+                    del redundancyState[host]
 
-            if ("systemName" in key) and (value):
-                self.systemName = value
+        return serviceState, redundancyState
 
-            if ("redundancy_services" in key) and (value):
 
-                self.redundancyStateServices = value
+class pollScheduler:
+    def __init__(self, monitor, interval=10, jitter=0.1, restart_limit=1000):
 
-                if "services" in kwargs.keys():
-                    self.monitor_services += value
+        # polls the monitor on its own thread every interval seconds (give or take jitter as a
+        # fraction of the interval) and keeps the documents of the latest finished poll, so
+        # fetch answers straight away. the documents are built on the polling thread because
+        # the monitor reuses its records on the next poll.
+        self.monitor = monitor
+        self.interval = interval
+        self.jitter = jitter
 
-        self.rpc_connect()
+        # every snapshot is complete, a delta against it would lose changes nobody fetched
+        self.monitor.delta = None
 
-    def do_ping(self):
+        # restart documents only happen on the poll that saw the restart, so they're queued
+        # until the next fetch (keeping the latest restart_limit) instead of going in the snapshot
+        self.restarts = []
+        self.restart_limit = restart_limit
+        self.lock = threading.Lock()
 
-        ping_def = {"id": self.rpcId(), "jsonrpc": "2.0", "method": "ping"}
+        self.snapshot = None
+        self.finished = None
+        self.ready = threading.Event()
+        self.stop = threading.Event()
 
-        ping_payload = json.dumps(ping_def) + self.endFrame
+        self.thread = threading.Thread(target=self.run, name="magnum-scheduler", daemon=True)
+        self.thread.start()
+
+    def poll(self):
 
-        resp = self.rpc_call(ping_payload)
+        start = time.perf_counter()
 
         try:
 
-            if resp["result"] == "pong":
-                return True
+            services, redundancy = self.monitor.create_status()
+            self.snapshot = self.monitor.documents_json(services, redundancy, restarts=None)
+            self.finished = time.monotonic()
 
-        except Exception:
-            return None
+            events = self.monitor.restart_json(services)
 
-    def set_version(self):
+            if events:
 
-        version_def = {
-            "id": self.rpcId(),
-            "jsonrpc": "2.0",
-            "method": "health.api.handshake",
-            "params": {"client_supported_versions": [2]},
-        }
+                self.monitor.stats.count("documents", len(events))
 
-        version_payload = json.dumps(version_def) + self.endFrame
+                with self.lock:
 
-        resp = self.rpc_call(version_payload)
+                    self.restarts.extend(events)
+                    del self.restarts[: -self.restart_limit]
 
-        try:
+            self.ready.set()
 
-            if resp["result"]["server_selected_version"] == 2:
-                return True
+        except Exception as e:
 
-        except Exception:
-            return None
+            print("scheduled poll:", e)
+            self.monitor.stats.count("schedule_errors")
 
-    def get_metrics(self):
+        self.monitor.stats.time("scheduled_poll", time.perf_counter() - start)
 
-        metrics_def = {"id": self.rpcId(), "jsonrpc": "2.0", "method": "get.health.metrics"}
+    def run(self):
 
-        metrics_payload = json.dumps(metrics_def) + self.endFrame
+        deadline = time.monotonic()
 
-        retries = 2
-        while retries > 0:
+        while not self.stop.is_set():
 
-            if self.do_ping():
-                if self.set_version():
+            self.poll()
 
-                    resp = self.rpc_call(metrics_payload)
+            deadline += self.interval
+            now = time.monotonic()
 
-                    try:
+            # a poll that ran past the next deadline skips those cycles instead of stacking them
+            if now > deadline:
 
-                        if "result" in resp:
-                            return resp["result"]
+                skipped = int((now - deadline) // self.interval) + 1
 
-                    except Exception:
-                        pass
+                deadline += skipped * self.interval
+                self.monitor.stats.count("skipped_polls", skipped)
 
-            self.rpc_close()
-            self.rpc_connect()
+            delay = deadline - now + random.uniform(-self.jitter, self.jitter) * self.interval
 
-            retries -= 1
+            self.stop.wait(max(delay, 0))
 
-        return None
+    def age(self):
 
-    def rpc_call(self, msg):
-        def empty_socket(sock):
-            """remove the data present on the socket"""
-            while True:
-                inputready, _, _ = select.select([sock], [], [], 0)
-                if len(inputready) == 0:
-                    break
-                for s in inputready:
-                    if not s.recv(1):
-                        return
+        return time.monotonic() - self.finished if self.finished else None
 
-        try:
+    def fetch(self, timeout=None):
 
-            empty_socket(self.sock)
-            self.sock.send(msg.encode("utf-8"))
+        # the latest documents with a snapshot document telling how old they are. the first
+        # fetch waits up to an interval for the first poll to finish.
+        if not self.ready.wait(self.interval if timeout is None else timeout):
+            return "[]"
 
-            responselist = []
+        snapshot, age = self.snapshot, self.age()
 
-            while True:
+        with self.lock:
+            events, self.restarts = self.restarts, []
 
-                try:
-                    data = self.sock.recv(1024).decode("utf-8")
-                except socket.timeout:
-                    break
-                if not data:
-                    break
+        document = {
+            "fields": {
+                "d_age_s": round(age, 3),
+                "d_interval_s": self.interval,
+                "s_system": self.monitor.systemName,
+                "s_type": "snapshot",
+            },
+            "host": self.monitor.magnum_ip,
+            "name": "snapshot",
+        }
 
-                responselist.append(data)
+        events.append(json.dumps(document))
 
-                if self.endFrame in data:
-                    break
+        return snapshot[:-1] + (", " if len(snapshot) > 2 else "") + ", ".join(events) + "]"
 
-            response = json.loads("".join(responselist))
+    def dispose(self):
 
-        except Exception:
-            return None
+        self.stop.set()
+        self.thread.join()
 
-        if self.verbose:
-            print("-->", msg.strip("\r\n"))
-            print("<--", json.dumps(response)[0:300])
-            print(json.dumps(response, indent=1))
+        self.monitor.dispose()
 
-        return response
 
-    def rpc_connect(self):
+class monitorCache:
+    def __init__(
+        self, systems=None, idle=3600, pool_size=8, poll_interval=None, deadline=5, **params
+    ):
+
+        # a processMonitor per magnum address, made the first time the address is fetched and
+        # disposed of once it hasn't been asked for in idle seconds. addresses are polled at the
+        # same time (at least pool_size at once) and the documents are merged into one list,
+        # each tagged with the system it came from (systems maps an address to its name,
+        # otherwise systemName). every other parameter goes to the monitors.
+        self.systems = systems or {}
+        self.idle = idle
+        self.pool_size = pool_size
+        self.poll_interval = poll_interval
+        self.params = params
+
+        # an address that hasn't answered within deadline seconds adds nothing to the fetch. it
+        # isn't polled again until that poll has finished.
+        self.deadline = deadline
+        self.pending = {}
+
+        self.monitors = {}
+        self.schedulers = {}
+        self.used = {}
+        self.executor = None
+        self.executor_size = 0
+
+    def monitor(self, address):
 
         try:
+            return self.monitors[address]
 
-            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.sock.settimeout(2)
-            self.sock.connect((self.magnum_ip, self.magnum_port))
+        except KeyError:
 
-            return True
+            params = dict(self.params)
+            params.update(
+                {
+                    "address": address,
+                    "systemName": self.systems.get(address, params.get("systemName")),
+                    "tag_system": True,
+                }
+            )
 
-        except Exception:
-            self.rpc_close()
+            monitor = self.monitors[address] = processMonitor(**params)
 
-        return None
+            if self.poll_interval:
+                self.schedulers[address] = pollScheduler(monitor, self.poll_interval)
 
-    def rpc_close(self):
+            return monitor
+
+    def documents(self, address):
+
+        monitor = self.monitor(address)
 
         try:
 
-            self.sock.shutdown(socket.SHUT_RDWR)
-            self.sock.close()
+            if address in self.schedulers:
+                return self.schedulers[address].fetch()
 
-            return True
+            services, redundancy = monitor.create_status()
 
-        except Exception:
-            return None
+            return monitor.documents_json(services, redundancy)
 
-    def rpcId(self):
+        except Exception as e:
 
-        self.rpc_id = random.randint(1, 10) if self.rpc_id > 99 else self.rpc_id + 1
+            print(address, e)
+            monitor.stats.count("fetch_errors")
 
-        return self.rpc_id
+            return "[]"
 
-    def group_metrics(self, metrics):
-        def create_service_dict():
+    def fetch(self, addresses):
 
-            services = {}
-            for service in self.monitor_services:
-                services.update({service: []})
+        now = time.monotonic()
 
-            return services
+        addresses = list(dict.fromkeys(addresses))
 
-        def autogenerate_service_dict(metric_list):
+        for address in addresses:
+            self.used[address] = now
 
-            Services = {}
+        if len(addresses) > 1:
+            results = self.gather(addresses)
 
-            for metric in metric_list:
+        else:
+            results = [self.documents(address) for address in addresses]
 
-                # next metric if any found service match.
-                # saves computing with the re libarary
-                if any(service in metric[0] for service in Services.keys()):
-                    continue
+        self.evict(now)
 
-                else:
+        return "[" + ", ".join(result[1:-1] for result in results if len(result) > 2) + "]"
 
-                    # access the process name from a string like "Services: magstoresrv Total Resident Memory"
-                    labelPattern = re.compile(r"Services:\s([a-zA-Z\-]*)\s.*")
-                    matchLabel = labelPattern.finditer(metric[0])
+    def gather(self, addresses):
 
-                    for match in matchLabel:
-                        Services.update({match.group(1): []})
+        # a thread for every address, so the ones that answer never queue behind the ones that
+        # are stuck. a slow address keeps its thread until its poll finishes.
+        if self.executor_size < max(self.pool_size, len(addresses)):
 
-            return Services
+            if self.executor:
+                self.executor.shutdown(wait=False)
 
-        if metrics:
+            self.executor_size = max(self.pool_size, len(addresses))
+            self.executor = ThreadPoolExecutor(max_workers=self.executor_size)
 
-            process_metrics = {}
-            cluster_information = {}
+        futures = {}
 
-            for _, hostCollection in metrics.items():
-
-                # create initial host trees for process dict and cluster information
-                # generate a nested service tree by either the class service list or call the
-                # auto generating function to discovery all the services from the metrics list.
-                process_metrics.update(
-                    {
-                        hostCollection["hostname"]: {
-                            "processes": create_service_dict()
-                            if len(self.monitor_services) > 0
-                            else autogenerate_service_dict(hostCollection["health_metrics"]),
-                            "overall_health": hostCollection["overall_health"],
-                        }
-                    }
-                )
+        for address in addresses:
 
-                cluster_information.update(
-                    {hostCollection["hostname"]: {"cluster_information": []}}
-                )
+            # still busy with a poll that missed an earlier deadline, its answer is stale
+            if address in self.pending and not self.pending[address].done():
+
+                self.monitor(address).stats.count("late_fetches")
+
+                continue
+
+            futures[address] = self.pending[address] = self.executor.submit(
+                self.documents, address
+            )
+
+        done, _ = wait(futures.values(), timeout=self.deadline)
+
+        results = []
+
+        for address, future in futures.items():
+
+            if future in done:
+
+                del self.pending[address]
+                results.append(future.result())
+
+            else:
+                self.monitor(address).stats.count("late_fetches")
+
+        return results
+
+    def evict(self, now):
+
+        for address, used in list(self.used.items()):
+
+            if now - used > self.idle:
+                self.remove(address)
+
+    def remove(self, address):
+
+        self.used.pop(address, None)
+        self.pending.pop(address, None)
+
+        scheduler = self.schedulers.pop(address, None)
+        monitor = self.monitors.pop(address, None)
+
+        if scheduler:
+            scheduler.dispose()
+
+        elif monitor:
+            monitor.dispose()
 
-                # reference in the process and cluster info lists
-                host_processes = process_metrics[hostCollection["hostname"]]["processes"]
-                host_cluster = cluster_information[hostCollection["hostname"]][
-                    "cluster_information"
+    def dispose(self):
+
+        for address in list(self.monitors.keys()):
+            self.remove(address)
+
+        if self.executor:
+
+            self.executor.shutdown()
+            self.executor = None
+
+
+def generate_metrics(hosts=2, services=20, metrics=6, resources=4):
+
+    # synthetic get.health.metrics result shaped like a real magnum system
+    kinds = [
+        ("State", lambda i: "Running"),
+        ("CPU Usage (%)", lambda i: "%.1f%%" % random.uniform(0, 40)),
+        ("Memory Usage (%)", lambda i: "%.1f%%" % random.uniform(0, 10)),
+        ("Total Resident Memory", lambda i: "%.1fM" % random.uniform(1, 2000)),
+        ("Main PID", lambda i: str(1000 + i)),
+        ("Uptime", lambda i: "%d days" % random.randint(0, 400)),
+        ("Open File Descriptors", lambda i: str(random.randint(10, 4000))),
+        ("Threads", lambda i: str(random.randint(1, 200))),
+    ]
+
+    tokens = ["cl-token", "cl-ip1", "db-ip1", "db-token"]
+
+    result = {}
+
+    for host in range(hosts):
+
+        hostname = "magnum-%s" % (host + 1)
+        health_metrics = []
+
+        for service in range(services):
+
+            name = "magsrv%s" % service
+
+            for index in range(metrics):
+
+                label, value = kinds[index % len(kinds)]
+
+                if index >= len(kinds):
+                    label = "%s %s" % (label, index // len(kinds))
+
+                health_metrics.append(["Services: %s %s" % (name, label), value(service), "Ok"])
+
+        # first host is the active server, the rest are standby
+        health_metrics.append(["Cluster: Maintenance mode", "No", "Ok"])
+        health_metrics.append(["Cluster: Server %s" % hostname, "Online", "Ok"])
+
+        for resource in range(resources):
+
+            resource_name = tokens[resource] if resource < len(tokens) else "res%s" % resource
+
+            health_metrics.append(
+                [
+                    "Cluster: Resource %s" % resource_name,
+                    "Started" if host == 0 else "Stopped",
+                    "Ok",
                 ]
+            )
+
+        result.update(
+            {
+                "10.0.%s.%s"
+                % (host // 250, host % 250 + 1): {
+                    "hostname": hostname,
+                    "health_metrics": health_metrics,
+                    "overall_health": "Ok",
+                }
+            }
+        )
 
-                for metric in hostCollection["health_metrics"]:
+    return result
 
-                    # check each service to see if it's in the metric desction.
-                    # if so add it to the service list
-                    for service in host_processes.keys():
-                        if service in metric[0]:
-                            host_processes[service].append(metric)
 
-                    if "Cluster" in metric[0]:
-                        host_cluster.append(metric)
+def benchmark(hosts=2, services=20, metrics=6, resources=4, polls=50, monitored=None, workers=None):
 
-            if self.verbose:
-                print(json.dumps(process_metrics, indent=1))
-                print(json.dumps(cluster_information, indent=1))
+    params = {
+        "address": "127.0.0.1",
+        "services": ["magsrv%s" % service for service in range(monitored)] if monitored else None,
+        "disable_connect": True,
+        "workers": workers,
+    }
 
-            return process_metrics, cluster_information
+    mag = processMonitor(**params)
 
-        return None, None
+    payload = generate_metrics(hosts, services, metrics, resources)
+    metric_count = sum(len(host["health_metrics"]) for host in payload.values())
 
-    def create_status(self):
+    # group_metrics is part of create_status, it's shown on its own as a sub-stage
+    stages = {"create_status": [], "group_metrics": [], "documents": []}
+    document_bytes = 0
 
-        redundancyState = None
-        serviceState = None
+    for _ in range(polls):
 
-        if not self.substituted:
+        start = time.perf_counter()
+        mag.group_metrics(payload)
+        stages["group_metrics"].append(time.perf_counter() - start)
 
-            process_metrics, cluster_information = self.group_metrics(self.get_metrics())
+        # create_status is timed the way the poller runs it, grouping included
+        start = time.perf_counter()
+        serviceState, redundancyState = mag.build_status(payload)
+        stages["create_status"].append(time.perf_counter() - start)
 
-        else:
+        start = time.perf_counter()
+        document_bytes = len(mag.documents_json(serviceState, redundancyState))
+        stages["documents"].append(time.perf_counter() - start)
 
-            import api_status
+    print(
+        "%s hosts, %s services/host, %s metrics/service, %s metrics/poll, %s polls"
+        % (hosts, services, metrics, metric_count, polls)
+    )
 
-            importlib.reload(api_status)
+    print("%-15s %12s %12s %12s %16s" % ("stage", "mean ms", "min ms", "max ms", "metrics/s"))
 
-            try:
+    for stage, timings in stages.items():
 
-                sample_metrics = eval("api_status." + self.substituted)
+        mean = sum(timings) / len(timings)
+        label = "  " + stage if stage == "group_metrics" else stage
 
-            except Exception as e:
-                print(e)
-                quit()
+        print(
+            "%-15s %12.3f %12.3f %12.3f %16.0f"
+            % (label, mean * 1000, min(timings) * 1000, max(timings) * 1000, metric_count / mean)
+        )
 
-            process_metrics, cluster_information = self.group_metrics(sample_metrics)
+    poll = (sum(stages["create_status"]) + sum(stages["documents"])) / polls
 
-        # calculate redundancy status information
-        if cluster_information:
+    print("total per poll: %.3f ms, %s bytes of documents" % (poll * 1000, document_bytes))
 
-            redundancyState = {}
+    mag.dispose()
 
-            for host, cluster_collection in cluster_information.items():
-
-                redundancyState.update(
-                    {
-                        host: {
-                            "s_host": host,
-                            "s_status": None,
-                            "s_maintenance": None,
-                            "s_online": None,
-                            "i_resources_running": 0,
-                            "i_resources_stopped": 0,
-                            "s_system": self.systemName,
-                            "s_type": "redundancy",
-                        }
-                    }
-                )
+    return stages
 
-                # tokens are the different resource names that control the cluster ip
-                # status list is used to store the state of each one to be verified later
-                clusterTokens = ["cl-token", "cl-ip1", "db-ip1", "db-token"]
-                clusterStatus = []
 
-                for item in cluster_collection["cluster_information"]:
+class mockHandler(socketserver.BaseRequestHandler):
+    def handle(self):
 
-                    if "Cluster: Maintenance mode" in item[0]:
-                        redundancyState[host]["s_maintenance"] = item[1]
+        server = self.server
+        buffer = bytearray()
 
-                    # some older magnum code uses this format (1.17.2), item[1] = Yes/No
-                    elif "Cluster: Online (%s)" % (host) in item[0]:
-                        redundancyState[host]["s_online"] = item[1]
+        while True:
 
-                    # newer magnum code uses this format (versions TBD), item[1] = Online/Offline
-                    elif "Cluster: Server %s" % (host) in item[0]:
-                        redundancyState[host]["s_online"] = item[1]
+            try:
+                data = self.request.recv(262144)
 
-                    elif any(match in item[0] for match in clusterTokens):
-                        clusterStatus.append(item[1])
+            except OSError:
+                return
 
-                    if "Cluster: Resource" in item[0]:
+            if not data:
+                return
 
-                        if any(match in item[1] for match in ["Started", "Slave", "Master"]):
-                            redundancyState[host]["i_resources_running"] += 1
+            buffer += data
 
-                        else:
-                            redundancyState[host]["i_resources_stopped"] += 1
+            while True:
 
-                # calculate redundancy status description. if server is offline then punt out a Server Error Offline
-                # if both token and ip1 is started or stopped then assume it's working Active or Standby
-                # if both do not match than assume there's a server error. probably need to add more combinations in the future.
+                index = buffer.find(b"\r\n")
 
-                # Yes = old version (~1.17.2), Online = newer versions...
-                if (
-                    redundancyState[host]["s_online"] == "Yes"
-                    or redundancyState[host]["s_online"] == "Online"
-                ):
+                if index < 0:
+                    break
 
-                    if all(status == "Started" for status in clusterStatus):
-                        redundancyState[host]["s_status"] = "Server Active/Online"
+                request = bytes(buffer[:index])
+                del buffer[: index + 2]
 
-                    elif all(status == "Stopped" for status in clusterStatus):
-                        redundancyState[host]["s_status"] = "Server Standby/Online"
+                if not self.respond(server, request):
+                    return
 
-                    else:
-                        redundancyState[host]["s_status"] = "Server Error Online"
+    def respond(self, server, request):
 
-                else:
-                    redundancyState[host]["s_status"] = "Server Error Offline"
+        try:
 
-            if self.verbose:
-                print(json.dumps(redundancyState, indent=1))
+            call = json.loads(request.decode("utf-8"))
+            rpc_id = json.dumps(call.get("id"))
+            method = call.get("method")
 
-        if process_metrics:
+        except Exception:
+            return True
 
-            serviceState = {}
+        server.requests += 1
 
-            # get all the process state and information
-            # iterate through each host branch
-            for host, host_collection in process_metrics.items():
-
-                serviceState.update({host: {}})
-
-                for service, metrics in host_collection["processes"].items():
-
-                    # configure a default set of information that is a missing metric for easy fallback
-                    serviceState[host].update(
-                        {
-                            service: {
-                                "s_service": service,
-                                "s_state": "Not Available",
-                                "i_id": -1,
-                                "d_cpu_p": 0,
-                                "d_memory_p": 0,
-                                "l_memory_b": 0,
-                                "i_pid": None,
-                                "s_cluster": None,
-                                "s_status": None,
-                                "s_type": "service",
-                            }
-                        }
-                    )
+        if method == "ping":
+            result = b'"pong"'
 
-                    # reference in the service def for easy access
-                    service_def = serviceState[host][service]
+        elif method == "health.api.handshake":
+            result = b'{"server_selected_version": 2}'
 
-                    # iterate through each of the list items for a process
-                    for metric in metrics:
+        elif method == "get.health.metrics":
 
-                        if "State" in metric[0]:
+            # dropped connection instead of an answer
+            if random.random() < server.drop:
+                return False
 
-                            # set value as-is
-                            service_def["s_state"] = metric[1]
+            result = server.result
 
-                            # set the id to 1 if string is running, otherwise just use 0.
-                            service_def["i_id"] = 1 if metric[1] == "Running" else 0
+        else:
 
-                            # chech if it's "Not Running" or "Stopped" while the server redundancy is known to be in a normal Standby/Online state
-                            # and the service is known as a redundancy state service, then rewrite the state as "Standby"
-                            # otherwise just leave the value as-is.
+            error = b'{"code": -32601, "message": "Method not found"}'
 
-                            # incase the redundancy state did not complete.
-                            try:
+            self.send(
+                b'{"id": %s, "jsonrpc": "2.0", "error": %s}\r\n' % (rpc_id.encode("utf-8"), error)
+            )
 
-                                if (
-                                    (metric[1] == "Not Running" or metric[1] == "Stopped")
-                                    and redundancyState[host]["s_status"] == "Server Standby/Online"
-                                    and service in self.redundancyStateServices
-                                ):
+            return True
 
-                                    service_def["s_state"] = "Standby"
-                                    service_def["i_id"] = 2
+        if server.latency:
+            time.sleep(server.latency)
 
-                            except Exception:
-                                pass
+        frame = b'{"id": %s, "jsonrpc": "2.0", "result": %s}\r\n' % (rpc_id.encode("utf-8"), result)
 
-                        elif "CPU Usage (%)" in metric[0]:
-                            service_def["d_cpu_p"] = round(float(metric[1].strip("%")) / 100, 3)
+        # stall part way through the frame
+        if method == "get.health.metrics" and random.random() < server.stall:
 
-                        elif "Memory Usage (%)" in metric[0]:
-                            service_def["d_memory_p"] = round(float(metric[1].strip("%")) / 100, 3)
+            half = len(frame) // 2
 
-                        elif "Total Resident Memory" in metric[0]:
+            self.send(frame[:half])
+            time.sleep(server.stall_time)
 
-                            try:
+            frame = frame[half:]
 
-                                byte_convert = {
-                                    "B": 1,
-                                    "K": 1000,
-                                    "M": 1000000,
-                                    "G": 1000000000,
-                                    "T": 1000000000000,
-                                }
-
-                                unit = metric[1][-1]
-                                value = metric[1].split(unit)[0]
-
-                                service_def["l_memory_b"] = int(float(value) * byte_convert[unit])
-
-                            except Exception:
-                                service_def["l_memory_b"] = 0
-
-                        elif "Cluster: Resource" in metric[0]:
-                            service_def["s_cluster"] = metric[1]
-
-                        elif "Main PID" in metric[0]:
-                            service_def["i_pid"] = metric[1]
-
-                        # set status to value if not set or anytime if value is not "Ok"
-                        # trying to get any unkown values to stay set that's worse than "OK"
-                        if (metric[2] != "Ok") or not service_def["s_status"]:
-                            service_def["s_status"] = metric[2]
-
-                # create overall metrics if the flag is left on
-                if self.overall:
-
-                    # create initial default information for overall health
-                    # state comes from the magnum overall health state.
-                    serviceState[host].update(
-                        {
-                            "overall_health": {
-                                "s_service": "overall_health",
-                                "s_state": "Running",
-                                "d_cpu_p": 0,
-                                "d_memory_p": 0,
-                                "l_memory_b": 0,
-                                "i_num_services": 0,
-                                "i_num_failed": 0,
-                                "s_status": host_collection["overall_health"],
-                                "s_type": "overall",
-                            }
-                        }
-                    )
+        self.send(frame)
 
-                    # create reference for easy access to def
-                    overall_health = serviceState[host]["overall_health"]
+        return True
 
-                    for service, metrics in serviceState[host].items():
+    def send(self, data):
 
-                        # don't add the overall health metrics to itself.
-                        if service != "overall_health":
+        fragment = self.server.fragment
 
-                            overall_health["d_cpu_p"] += metrics["d_cpu_p"]
-                            overall_health["d_memory_p"] += metrics["d_memory_p"]
-                            overall_health["l_memory_b"] += metrics["l_memory_b"]
-                            overall_health["i_num_services"] += 1
+        if not fragment:
+            self.request.sendall(data)
+            return
 
-                            if metrics["s_state"] != "Running" and metrics["s_state"] != "Standby":
-                                overall_health["s_state"] = "Not Running"
-                                overall_health["i_num_failed"] += 1
+        for index in range(0, len(data), fragment):
+            self.request.sendall(data[index : index + fragment])
 
-                            # fix some trailing decimal values that go on for like ever
-                            overall_health["d_cpu_p"] = round(overall_health["d_cpu_p"], 3)
-                            overall_health["d_memory_p"] = round(overall_health["d_memory_p"], 3)
 
-            if self.verbose:
-                print(json.dumps(serviceState, indent=1))
+class mockServer(socketserver.ThreadingTCPServer):
 
-        return serviceState, redundancyState
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(
+        self,
+        address="127.0.0.1",
+        port=12021,
+        latency=0,
+        fragment=0,
+        drop=0,
+        stall=0,
+        stall_time=5,
+        **kwargs
+    ):
+
+        # stand in for a magnum cluster ip speaking the RPC-JSON health api. kwargs size the
+        # payload the same as generate_metrics (hosts, services, metrics, resources).
+        # latency is seconds before each answer, fragment sends frames in pieces of that many
+        # bytes, drop and stall are the chance a metrics request has the connection dropped
+        # or stalls half way through the frame for stall_time seconds.
+        self.latency = latency
+        self.fragment = fragment
+        self.drop = drop
+        self.stall = stall
+        self.stall_time = stall_time
+        self.requests = 0
+
+        self.result = json.dumps(generate_metrics(**kwargs)).encode("utf-8")
+
+        super().__init__((address, port), mockHandler)
 
 
 def main():
@@ -542,6 +3242,9 @@ def main():
     sub_manual.add_argument(
         "-IP", "--address", metavar="172.16.112.20", required=True, help="Magnum Cluster IP Address"
     )
+    sub_manual.add_argument(
+        "-P", "--port", type=int, required=False, help="Magnum RPC-JSON port (default 12021)"
+    )
     sub_manual.add_argument(
         "-S",
         "--services",
@@ -568,12 +3271,78 @@ def main():
         required=False,
         help="Disable the overall status",
     )
+    sub_manual.add_argument(
+        "-no-session",
+        "--session_disable",
+        action="store_true",
+        required=False,
+        help="Ping and negotiate the api version on every poll",
+    )
+    sub_manual.add_argument(
+        "-failover",
+        "--failover",
+        action="store_true",
+        required=False,
+        help="Keep connections to each Magnum server to fail over to when the cluster IP fails",
+    )
+    sub_manual.add_argument(
+        "-stream",
+        "--stream",
+        action="store_true",
+        required=False,
+        help="Process each server's metrics as soon as it arrives instead of the whole response",
+    )
+    sub_manual.add_argument(
+        "-delta",
+        "--delta",
+        action="store_true",
+        required=False,
+        help="Only output the service and redundancy information that changed",
+    )
+    sub_manual.add_argument(
+        "-workers",
+        "--workers",
+        type=int,
+        metavar="4",
+        required=False,
+        help="Process the servers and their documents on a pool of this many worker threads",
+    )
+    sub_manual.add_argument(
+        "-adaptive",
+        "--adaptive",
+        action="store_true",
+        required=False,
+        help="Fit the RPC timeout to the measured latency and back off from a server that's down",
+    )
+    sub_manual.add_argument(
+        "-history",
+        "--history",
+        type=int,
+        metavar="30",
+        required=False,
+        help="Keep this many polls of each service for averages, memory growth and restarts",
+    )
+    sub_manual.add_argument(
+        "-restarts",
+        "--restarts",
+        action="store_true",
+        required=False,
+        help="Output a restart document whenever the PID of a service changes",
+    )
+    sub_manual.add_argument(
+        "-capture",
+        "--capture",
+        metavar="metrics.jsonl.gz",
+        required=False,
+        help="Record every raw metrics answer to a rotating json lines file (.gz to compress)",
+    )
     sub_manual.add_argument(
         "-z",
         "--fakeit",
         metavar="sdvn_status",
         required=False,
-        help="supplement some fake data from api_status file",
+        help="supplement some fake data from api_status file, or replay a capture file "
+        "(json or json lines, one get.health.metrics answer per poll)",
     )
     sub_manual.add_argument(
         "-v",
@@ -583,6 +3352,102 @@ def main():
         help="enable a more detailed output for troubleshooting",
     )
 
+    sub_bench = sub.add_parser(
+        "bench", help="time the processing pipeline against synthetic Magnum metrics"
+    )
+    sub_bench.set_defaults(which="bench")
+    sub_bench.add_argument(
+        "-H", "--hosts", type=int, default=2, required=False, help="Number of Magnum servers"
+    )
+    sub_bench.add_argument(
+        "-S", "--services", type=int, default=20, required=False, help="Services per server"
+    )
+    sub_bench.add_argument(
+        "-M", "--metrics", type=int, default=6, required=False, help="Metrics per service"
+    )
+    sub_bench.add_argument(
+        "-C",
+        "--resources",
+        type=int,
+        default=4,
+        required=False,
+        help="Cluster resources per server",
+    )
+    sub_bench.add_argument(
+        "-n", "--polls", type=int, default=50, required=False, help="Number of polls to time"
+    )
+    sub_bench.add_argument(
+        "-m",
+        "--monitored",
+        type=int,
+        required=False,
+        help="Monitor this many services from a list instead of auto discovering them",
+    )
+    sub_bench.add_argument(
+        "-w", "--workers", type=int, required=False, help="Process the servers on a worker pool"
+    )
+
+    sub_mock = sub.add_parser("mock", help="run a stand in Magnum RPC-JSON server for testing")
+    sub_mock.set_defaults(which="mock")
+    sub_mock.add_argument(
+        "-b", "--bind", default="127.0.0.1", required=False, help="Address to listen on"
+    )
+    sub_mock.add_argument(
+        "-p", "--port", type=int, default=12021, required=False, help="Port to listen on"
+    )
+    sub_mock.add_argument(
+        "-H", "--hosts", type=int, default=2, required=False, help="Number of Magnum servers"
+    )
+    sub_mock.add_argument(
+        "-S", "--services", type=int, default=20, required=False, help="Services per server"
+    )
+    sub_mock.add_argument(
+        "-M", "--metrics", type=int, default=6, required=False, help="Metrics per service"
+    )
+    sub_mock.add_argument(
+        "-C",
+        "--resources",
+        type=int,
+        default=4,
+        required=False,
+        help="Cluster resources per server",
+    )
+    sub_mock.add_argument(
+        "-l", "--latency", type=float, default=0, required=False, help="Seconds before answering"
+    )
+    sub_mock.add_argument(
+        "-f",
+        "--fragment",
+        type=int,
+        default=0,
+        required=False,
+        help="Send frames in pieces of this many bytes",
+    )
+    sub_mock.add_argument(
+        "-d",
+        "--drop",
+        type=float,
+        default=0,
+        required=False,
+        help="Chance (0-1) a metrics request has the connection dropped",
+    )
+    sub_mock.add_argument(
+        "-s",
+        "--stall",
+        type=float,
+        default=0,
+        required=False,
+        help="Chance (0-1) a metrics answer stalls half way through the frame",
+    )
+    sub_mock.add_argument(
+        "-st",
+        "--stall_time",
+        type=float,
+        default=5,
+        required=False,
+        help="Seconds a stalled answer waits",
+    )
+
     sub_auto = sub.add_parser(
         "auto", help="generate command automatically from external file or from inside the script"
     )
@@ -614,16 +3479,67 @@ def main():
 
     # args = parser.parse_args(["manual", "-IP", "10.9.1.24", "-N", "ClientHost"])
 
+    if args.which == "bench":
+
+        benchmark(
+            args.hosts,
+            args.services,
+            args.metrics,
+            args.resources,
+            args.polls,
+            args.monitored,
+            args.workers,
+        )
+
+        return
+
+    if args.which == "mock":
+
+        server = mockServer(
+            args.bind,
+            args.port,
+            latency=args.latency,
+            fragment=args.fragment,
+            drop=args.drop,
+            stall=args.stall,
+            stall_time=args.stall_time,
+            hosts=args.hosts,
+            services=args.services,
+            metrics=args.metrics,
+            resources=args.resources,
+        )
+
+        print("listening on %s:%s (%s byte answers)" % (args.bind, args.port, len(server.result)))
+
+        try:
+            server.serve_forever()
+
+        except KeyboardInterrupt:
+            server.server_close()
+
+        return
+
     if args.which == "manual":
 
         params = {
             "address": args.address,
+            "port": args.port,
             "services": args.services,
             "redundancy_services": args.redundancyservices,
             "systemName": args.system,
             "verbose": args.verbose,
             "subdata": args.fakeit,
             "disable_overall": args.overall_disable,
+            "disable_session": args.session_disable,
+            "failover": args.failover,
+            "stream": args.stream,
+            "delta": args.delta,
+            "workers": args.workers,
+            "history": args.history,
+            "restart_events": args.restarts,
+            "capture": args.capture,
+            "adaptive_timeout": args.adaptive,
+            "backoff": args.adaptive,
         }
 
         mag = processMonitor(**params)
@@ -1,24 +1,21 @@
-import json
 from insite_plugin import InsitePlugin
-from magnum_process import processMonitor
+from magnum_process import monitorCache
 
 
 class Plugin(InsitePlugin):
     def can_group(self):
-        return False
+        # every host comes in one fetch, so monitorCache can poll them at the same time
+        return True
 
     def fetch(self, hosts):
 
-        host = hosts[-1]
-
         try:
 
-            self.monitor
+            self.monitors
 
         except Exception:
 
             params = {
-                "address": host,
                 "services": [
                     "magsysmgr",
                     "magsigmonsrv",
@@ -44,50 +41,41 @@ class Plugin(InsitePlugin):
                 "systemName": "Magnum-SDVN",
                 "verbose": None,
                 "subdata": None,
+                "capture": None,
                 "disable_overall": None,
+                "disable_session": None,
+                "failover": None,
+                "adaptive_timeout": None,
+                "backoff": None,
+                "stream": None,
+                "workers": None,
+                "delta": None,
+                "delta_refresh": 10,
+                "history": None,
+                "restart_events": None,
+                "poller_stats": None,
             }
 
-            self.monitor = processMonitor(**params)
-
-        documents = []
-
-        services, redundancy = self.monitor.create_status()
-
-        if services:
-
-            for server, processes in services.items():
-
-                for _, metrics in processes.items():
-
-                    # remove None values so it doesn't break
-                    for key, value in list(metrics.items()):
-                        if value is None:
-                            metrics.pop(key, None)
-
-                    document = {"fields": metrics, "host": server, "name": "service"}
-
-                    documents.append(document)
-
-        if redundancy:
-
-            for server, info in redundancy.items():
-
-                # remove None values so it doesn't break
-                for key, value in list(metrics.items()):
-                    if value is None:
-                        metrics.pop(key, None)
+            # system name of each cluster ip address, any host not listed uses systemName
+            systems = {}
 
-                document = {"fields": info, "host": server, "name": "redundancy"}
+            # seconds between polls made in the background, None polls on every fetch instead
+            poll_interval = None
 
-                documents.append(document)
+            # every host is polled at the same time, a host that hasn't answered within deadline
+            # seconds is left out of that fetch, and a host no longer in the hosts list is let go
+            # of after idle seconds
+            self.monitors = monitorCache(
+                systems, idle=3600, poll_interval=poll_interval, deadline=5, **params
+            )
 
-        return json.dumps(documents)
+        return self.monitors.fetch(hosts)
 
     def dispose(self):
 
         try:
 
-            self.monitor.rpc_close()
+            self.monitors.dispose()
 
         except Exception:
             pass